@@ -1,18 +1,26 @@
 import os
 import json
+import math
 import sqlite3
 import sys
 import time
 import base64
+import bisect
+import heapq
+import threading
 import uuid
+import zlib
+from collections import deque
 from pathlib import Path
+from urllib.parse import quote
 
-from flask import Flask, render_template, redirect, url_for, request, session, jsonify, abort
-from flask_socketio import SocketIO, join_room
+from flask import Flask, render_template, redirect, url_for, request, session, jsonify, abort, g, has_app_context, send_file
+from flask_socketio import SocketIO, join_room, emit
 
 APP_DIR = Path(__file__).resolve().parent
 CONFIG_PATH = APP_DIR / "config.json"
-DB_PATH = APP_DIR / "mystery.db"
+# MYSTERY_DB_PATH points the app at another database file, e.g. a scratch one in tests.
+DB_PATH = Path(os.environ.get("MYSTERY_DB_PATH") or APP_DIR / "mystery.db")
 JUKEBOX_DIR = APP_DIR / "static" / "jukebox"
 PHOTOBOOTH_DIR = APP_DIR / "static" / "photobooth"
 
@@ -27,9 +35,50 @@ SCHOOL_TITLE = CONFIG["school"].get("display_title", SCHOOL_NAME)
 GAME_CONFIG = CONFIG["game"]
 STARTING_BALANCE = int(GAME_CONFIG["starting_balance"])
 ACCUSE_COOLDOWN_SECONDS = int(GAME_CONFIG["accuse_cooldown_seconds"])
+SUSPECT_HEAT_WINDOW_SECONDS = int(GAME_CONFIG.get("suspect_heat_window_seconds", 900))
 THRILLER_FILENAME = CONFIG["jukebox"]["thriller_filename"]
+JUKEBOX_PREFER_LOW_BITRATE = bool(CONFIG["jukebox"].get("prefer_low_bitrate", False))
+JUKEBOX_PRELOAD_SECONDS = float(CONFIG["jukebox"].get("preload_seconds", 20))
+JUKEBOX_LATE_GRACE_SECONDS = float(CONFIG["jukebox"].get("late_grace_seconds", 3))
+# Token buckets per player action: up to `capacity` back to back, then one more
+# every `refill_seconds`. Only accusations are limited out of the box; posts, DMs
+# and wallet actions can be limited from "rate_limits" in config.json, e.g.
+# "post": {"capacity": 5, "refill_seconds": 12}. An action with no entry is unlimited.
+RATE_LIMIT_DEFAULTS = {
+    "accuse": {"capacity": 1, "refill_seconds": ACCUSE_COOLDOWN_SECONDS},
+} if ACCUSE_COOLDOWN_SECONDS > 0 else {}
+
+def load_rate_limits(overrides):
+    """Merge config "rate_limits" over the defaults, checking each bucket at startup."""
+    limits = {}
+    for action in {*RATE_LIMIT_DEFAULTS, *overrides}:
+        limit = {**RATE_LIMIT_DEFAULTS.get(action, {}), **(overrides.get(action) or {})}
+        try:
+            capacity = int(limit["capacity"])
+            refill_seconds = float(limit["refill_seconds"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"rate_limits.{action} needs a numeric capacity and refill_seconds") from None
+        if capacity < 1 or refill_seconds <= 0:
+            raise ValueError(f"rate_limits.{action} needs capacity >= 1 and refill_seconds > 0")
+        limits[action] = {"capacity": capacity, "refill_seconds": refill_seconds}
+    return limits
+
+RATE_LIMITS = load_rate_limits(CONFIG.get("rate_limits", {}))
 CHARACTER_SEED = CONFIG["characters"]
 
+# WAL lets the TV and phones keep reading while a write commits; NORMAL sync only
+# fsyncs at checkpoints, which is the main per-commit cost on the Pi's SD card.
+DB_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -8000",
+    "PRAGMA mmap_size = 67108864",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA foreign_keys = ON",
+)
+DB_POOL_SIZE = 8
+
 
 def resolve_async_mode():
     """Prefer eventlet when available, but avoid it on Python 3.13+ until support is stable."""
@@ -47,15 +96,180 @@ ASYNC_MODE = resolve_async_mode()
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "dev-secret-key")
 socketio = SocketIO(app, async_mode=ASYNC_MODE, cors_allowed_origins="*")
-last_accuse_times = {}
 
 # ---------- DB helpers ----------
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
+_db_pool = []
+_db_pool_lock = threading.Lock()
+_db_local = threading.local()
+
+def open_db():
+    conn = sqlite3.connect(DB_PATH, timeout=5, check_same_thread=False)
     conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON")
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def acquire_db():
+    # Never blocks: under eventlet a blocking pool wait would stall the whole hub,
+    # so an empty pool just opens another connection.
+    with _db_pool_lock:
+        if _db_pool:
+            return _db_pool.pop()
+    return open_db()
+
+def release_db(conn):
+    if conn.in_transaction:
+        conn.rollback()
+    with _db_pool_lock:
+        if len(_db_pool) < DB_POOL_SIZE:
+            _db_pool.append(conn)
+            return
+    conn.close()
+
+def get_db():
+    """Return the connection for the current request or Socket.IO handler.
+
+    The same connection is reused for the whole app context and handed back to
+    the pool on teardown. Outside an app context (startup, background tasks) each
+    thread keeps its own long-lived connection.
+    """
+    if has_app_context():
+        conn = g.get("db_conn")
+        if conn is None:
+            conn = g.db_conn = acquire_db()
+        return conn
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = _db_local.conn = open_db()
     return conn
 
+@app.teardown_appcontext
+def release_request_db(exc):
+    conn = g.pop("db_conn", None)
+    if conn is not None:
+        release_db(conn)
+
+# ---------- Write queue ----------
+WRITE_BATCH_MAX = 64
+WRITE_BATCH_WINDOW_SECONDS = 0.002
+
+class WriteFuture:
+    """Handle for a queued write job; result() waits for the batch commit."""
+
+    __slots__ = ("fn", "done", "value", "error")
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.done = socketio.server.eio.create_event()
+        self.value = None
+        self.error = None
+
+    def result(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class DatabaseWriter:
+    """Single writer that runs every mutation on one connection.
+
+    Jobs are callables taking the writer's connection. Whatever is queued while a
+    batch is being collected commits together in one BEGIN IMMEDIATE transaction,
+    so a burst of posts costs one fsync. Each job runs inside its own savepoint:
+    an exception rolls back only that job and is re-raised from its future.
+    Jobs must not commit, and must not call db_write themselves. Jobs register
+    in-memory follow-ups with on_commit(); they run once the batch is durable
+    and before any caller in the batch is woken.
+
+    commit_lock is held from a batch's first job until its callbacks are done.
+    A cache that cold-loads under it sees each commit either in the rows it
+    reads or through the callbacks that follow, never both.
+    """
+
+    def __init__(self):
+        self._queue = None
+        self._start_lock = threading.Lock()
+        self._job_callbacks = None
+        self.commit_lock = threading.RLock()
+
+    def submit(self, fn):
+        if self._queue is None:
+            self._start()
+        future = WriteFuture(fn)
+        self._queue.put(future)
+        return future
+
+    def _start(self):
+        with self._start_lock:
+            if self._queue is None:
+                self._queue = socketio.server.eio.create_queue()
+                socketio.start_background_task(self._run)
+
+    def _run(self):
+        conn = open_db()
+        queue_empty = socketio.server.eio.get_queue_empty_exception()
+        while True:
+            batch = [self._queue.get()]
+            socketio.sleep(WRITE_BATCH_WINDOW_SECONDS)
+            while len(batch) < WRITE_BATCH_MAX:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue_empty:
+                    break
+            with self.commit_lock:
+                self._commit_batch(conn, batch)
+            for future in batch:
+                future.done.set()
+
+    def _commit_batch(self, conn, batch):
+        callbacks = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for future in batch:
+                self._job_callbacks = []
+                conn.execute("SAVEPOINT write_job")
+                try:
+                    future.value = future.fn(conn)
+                    callbacks.extend(self._job_callbacks)
+                except Exception as exc:
+                    conn.execute("ROLLBACK TO write_job")
+                    future.error = exc
+                conn.execute("RELEASE write_job")
+            self._job_callbacks = None
+            conn.commit()
+        except Exception as exc:
+            app.logger.exception("Write batch of %s jobs failed", len(batch))
+            self._job_callbacks = None
+            callbacks = []
+            if conn.in_transaction:
+                conn.rollback()
+            for future in batch:
+                if future.error is None:
+                    future.error = exc
+                    future.value = None
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                app.logger.exception("on_commit callback failed")
+
+    def on_commit(self, callback):
+        if self._job_callbacks is None:
+            raise RuntimeError("on_commit() is only available inside a write job")
+        self._job_callbacks.append(callback)
+
+db_writer = DatabaseWriter()
+
+def submit_write(fn):
+    return db_writer.submit(fn)
+
+def db_write(fn):
+    return db_writer.submit(fn).result()
+
+def on_commit(callback):
+    db_writer.on_commit(callback)
+
+# ---------- Schema ----------
 def ensure_characters_table(conn):
     balance_default = int(STARTING_BALANCE)
     conn.execute("""
@@ -113,6 +327,7 @@ def ensure_messages_table(conn):
         body TEXT NOT NULL,
         is_anonymous INTEGER NOT NULL DEFAULT 0,
         is_read INTEGER NOT NULL DEFAULT 0,
+        pinned INTEGER NOT NULL DEFAULT 0,
         ts DATETIME DEFAULT CURRENT_TIMESTAMP,
         FOREIGN KEY(sender_id) REFERENCES characters(id),
         FOREIGN KEY(recipient_id) REFERENCES characters(id)
@@ -218,8 +433,10 @@ def ensure_wallet_notifications_table(conn):
     )
     """)
 
-def init_db():
-    conn = get_db()
+# ---------- Schema migrations ----------
+def migrate_baseline_schema(conn):
+    # Databases created before versioning report user_version 0, so the baseline
+    # still upgrades older table shapes in place.
     ensure_characters_table(conn)
     ensure_messages_table(conn)
     ensure_accusations_table(conn)
@@ -227,29 +444,237 @@ def init_db():
     ensure_photobooth_table(conn)
     ensure_wallet_requests_table(conn)
     ensure_wallet_notifications_table(conn)
-    conn.commit()
-    conn.close()
 
-def reset_and_seed():
+def migrate_hot_query_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_public_feed ON messages(type, pinned, ts, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_dm_pair ON messages(type, sender_id, recipient_id, ts, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_dm_unread ON messages(type, recipient_id, is_read, sender_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jukebox_queue_status ON jukebox_queue(status, priority, requested_at, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jukebox_queue_song ON jukebox_queue(song_filename, status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_wallet_requests_target ON wallet_requests(target_id, status, request_type, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_wallet_notifications_recipient ON wallet_notifications(recipient_id, status, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_photostrips_created ON photostrips(created_at, id)")
+
+def migrate_feed_cursors(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS app_state (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_type_id ON messages(type, id)")
+
+def migrate_dm_threads(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS dm_threads (
+        owner_id INTEGER NOT NULL,
+        other_id INTEGER NOT NULL,
+        last_message_id INTEGER NOT NULL,
+        last_body TEXT NOT NULL,
+        last_ts TEXT NOT NULL,
+        last_sender_id INTEGER NOT NULL,
+        unread_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (owner_id, other_id)
+    ) WITHOUT ROWID
+    """)
+    # Backfill one row per side of every existing conversation.
+    conn.execute("""
+    INSERT OR REPLACE INTO dm_threads
+        (owner_id, other_id, last_message_id, last_body, last_ts, last_sender_id, unread_count)
+    SELECT owner_id, other_id, id, body, ts, sender_id, unread_count
+    FROM (
+        SELECT sides.*,
+               ROW_NUMBER() OVER (PARTITION BY owner_id, other_id ORDER BY ts DESC, id DESC) AS rn,
+               SUM(unread) OVER (PARTITION BY owner_id, other_id) AS unread_count
+        FROM (
+            SELECT id, body, ts, sender_id, sender_id AS owner_id, recipient_id AS other_id, 0 AS unread
+            FROM messages
+            WHERE type = 'dm' AND sender_id <> recipient_id
+            UNION ALL
+            SELECT id, body, ts, sender_id, recipient_id, sender_id, is_read = 0
+            FROM messages
+            WHERE type = 'dm' AND sender_id <> recipient_id
+        ) AS sides
+    )
+    WHERE rn = 1
+    """)
+
+def migrate_dm_thread_pages(conn):
+    # Threads are paged by id now; the ts-ordered pair index has no readers left.
+    conn.execute("DROP INDEX IF EXISTS idx_messages_dm_pair")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_dm_page ON messages(type, sender_id, recipient_id, id)")
+
+def migrate_message_search(conn):
+    # External-content index: the text lives in messages, triggers keep it in step.
+    conn.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        body,
+        content='messages',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, body) VALUES (new.id, new.body);
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, body) VALUES ('delete', old.id, old.body);
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF body ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, body) VALUES ('delete', old.id, old.body);
+        INSERT INTO messages_fts (rowid, body) VALUES (new.id, new.body);
+    END
+    """)
+    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+# Every balance change is one row here; characters.balance is the running total,
+# kept in step by ledger_transfer(). from_id is NULL for a character's opening
+# balance.
+OPENING_LEDGER_SQL = """
+    INSERT INTO wallet_ledger (from_id, to_id, amount, kind)
+    SELECT NULL, id, balance, 'opening' FROM characters WHERE balance > 0
+"""
+
+def migrate_wallet_ledger(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS wallet_ledger (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        from_id INTEGER,
+        to_id INTEGER NOT NULL,
+        amount INTEGER NOT NULL CHECK (amount > 0),
+        kind TEXT NOT NULL,
+        request_id INTEGER,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(from_id) REFERENCES characters(id),
+        FOREIGN KEY(to_id) REFERENCES characters(id)
+    )
+    """)
+    for action in ("UPDATE", "DELETE"):
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS wallet_ledger_no_{action.lower()} BEFORE {action} ON wallet_ledger BEGIN
+            SELECT RAISE(ABORT, 'wallet_ledger is append-only');
+        END
+        """)
+    # Whatever balances exist today become the opening entries.
+    conn.execute(OPENING_LEDGER_SQL)
+
+def migrate_wallet_events(conn):
+    # Per-character wallet feed; clients replay it from their last seen id.
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS wallet_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        character_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        other_id INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        request_id INTEGER,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(character_id) REFERENCES characters(id)
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_wallet_events_character ON wallet_events(character_id, id)")
+
+def migrate_accusation_window(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_accusations_ts ON accusations(ts, accused_id, points)")
+
+def migrate_pending_sends(conn):
+    # Settlement and its startup check only look at pending sends, which are
+    # a handful of rows however long the request history gets.
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_wallet_requests_pending_send
+        ON wallet_requests(id) WHERE request_type = 'send' AND status = 'pending'
+    """)
+
+def migrate_drop_jukebox_queue_indexes(conn):
+    # The jukebox engine keeps the queue in memory and only reads the table
+    # back on startup, so these indexes cost every queue write for nothing.
+    conn.execute("DROP INDEX IF EXISTS idx_jukebox_queue_status")
+    conn.execute("DROP INDEX IF EXISTS idx_jukebox_queue_song")
+
+def migrate_rate_limits(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS rate_limits (
+        character_id INTEGER NOT NULL,
+        action TEXT NOT NULL,
+        tokens REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        PRIMARY KEY (character_id, action)
+    ) WITHOUT ROWID
+    """)
+
+# Append only: each migration runs once per database, in order, and bumps
+# PRAGMA user_version in the same transaction as its schema changes.
+MIGRATIONS = [
+    (1, "baseline schema", migrate_baseline_schema),
+    (2, "hot query indexes", migrate_hot_query_indexes),
+    (3, "feed cursors", migrate_feed_cursors),
+    (4, "dm thread summaries", migrate_dm_threads),
+    (5, "dm thread pages", migrate_dm_thread_pages),
+    (6, "message search", migrate_message_search),
+    (7, "wallet ledger", migrate_wallet_ledger),
+    (8, "wallet events", migrate_wallet_events),
+    (9, "rate limits", migrate_rate_limits),
+    (10, "accusation window", migrate_accusation_window),
+    (11, "pending sends", migrate_pending_sends),
+    (12, "drop jukebox queue indexes", migrate_drop_jukebox_queue_indexes),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate_db():
     conn = get_db()
-    cur = conn.cursor()
-    cur.execute("DROP TABLE IF EXISTS messages")
-    cur.execute("DROP TABLE IF EXISTS accusations")
-    cur.execute("DROP TABLE IF EXISTS jukebox_queue")
-    cur.execute("DROP TABLE IF EXISTS wallet_requests")
-    cur.execute("DROP TABLE IF EXISTS wallet_notifications")
-    cur.execute("DROP TABLE IF EXISTS photostrips")
-    cur.execute("DROP TABLE IF EXISTS characters")
-    conn.commit()
-    conn.close()
+    if get_schema_version(conn) >= SCHEMA_VERSION:
+        return
+    for version, name, migration in MIGRATIONS:
+        # BEGIN IMMEDIATE takes the write lock first, so a second process starting
+        # at the same time waits and then sees the bumped version.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        app.logger.info("Applied schema migration %s (%s)", version, name)
+
+def drop_game_tables(conn):
+    conn.execute("DROP TABLE IF EXISTS dm_threads")
+    conn.execute("DROP TABLE IF EXISTS messages_fts")
+    conn.execute("DROP TABLE IF EXISTS messages")
+    conn.execute("DROP TABLE IF EXISTS accusations")
+    conn.execute("DROP TABLE IF EXISTS jukebox_queue")
+    conn.execute("DROP TABLE IF EXISTS wallet_requests")
+    conn.execute("DROP TABLE IF EXISTS wallet_notifications")
+    conn.execute("DROP TABLE IF EXISTS wallet_ledger")
+    conn.execute("DROP TABLE IF EXISTS wallet_events")
+    conn.execute("DROP TABLE IF EXISTS rate_limits")
+    conn.execute("DROP TABLE IF EXISTS photostrips")
+    conn.execute("DROP TABLE IF EXISTS characters")
+    touch_resources("feed", "jukebox", "photostrips")
+    conn.execute("PRAGMA user_version = 0")
+
+def reset_and_seed():
+    db_write(drop_game_tables)
+    feed_cache.clear()
+    unread_counters.clear()
+    roster.clear()
 
     if PHOTOBOOTH_DIR.exists():
         for path in PHOTOBOOTH_DIR.iterdir():
             if path.is_file():
                 path.unlink()
 
-    init_db()
-
     characters = []
     for character in CHARACTER_SEED:
         characters.append((
@@ -263,49 +688,721 @@ def reset_and_seed():
             character["login_code"],
         ))
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.executemany("""
-        INSERT INTO characters (name, role_tag, bio, avatar_emoji, is_alive, suspect_score, balance, login_code)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """, characters)
-    conn.commit()
-    conn.close()
-
-# ---------- Helpers ----------
-def get_logged_in_character():
-    char_id = session.get("character_id")
-    if not char_id:
+    # Migrations take their own write lock, so they run beside the writer rather than through it.
+    migrate_db()
+    def seed_characters(conn):
+        conn.executemany("""
+            INSERT INTO characters (name, role_tag, bio, avatar_emoji, is_alive, suspect_score, balance, login_code)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, characters)
+        conn.execute(OPENING_LEDGER_SQL)
+        bump_feed_epoch(conn)
+        on_commit(roster.reload)
+
+    db_write(seed_characters)
+    leaderboard.clear()
+    jukebox.clear()
+
+# ---------- Emit broker ----------
+EMIT_TICK_SECONDS = 0.03
+
+def merge_leaderboard(old, new):
+    changes = {change["character_id"]: change for change in old["changes"]}
+    changes.update((change["character_id"], change) for change in new["changes"])
+    return {"changes": list(changes.values())}
+
+# Events that describe current state rather than something that happened: only
+# the latest per slot is worth sending. jukebox_now and jukebox_stop share one.
+EMIT_SLOTS = {
+    "suspect_update": lambda payload: ("suspect_update", payload["character_id"]),
+    "character_status": lambda payload: ("character_status", payload["character_id"]),
+    "unread_counts": lambda payload: ("unread_counts",),
+    "phase_change": lambda payload: ("phase_change",),
+    "public_cleared": lambda payload: ("public_cleared",),
+    "photobooth_clear": lambda payload: ("photobooth_clear",),
+    "announcement_clear": lambda payload: ("announcement_clear",),
+    "jukebox_now": lambda payload: ("jukebox_state",),
+    "jukebox_stop": lambda payload: ("jukebox_state",),
+    "jukebox_queue": lambda payload: ("jukebox_queue",),
+    "jukebox_next": lambda payload: ("jukebox_next",),
+    "leaderboard": lambda payload: ("leaderboard",),
+}
+EMIT_MERGES = {"leaderboard": merge_leaderboard}
+
+class EmitBroker:
+    """Collects Socket.IO events for one tick and sends each room one frame.
+
+    Events queue per room (None is everyone) and go out together as a single
+    `batch` frame of [name, payload] pairs; the pages hand each pair to their
+    normal listeners. State events in EMIT_SLOTS replace the pending one for
+    the same slot and move to the end, so a client only sees the final state
+    and sees it after everything that led to it.
+    """
+
+    def __init__(self, tick_seconds):
+        self.tick_seconds = tick_seconds
+        self._lock = threading.Lock()
+        self._rooms = {}
+        self._scheduled = False
+        self._sequence = 0
+
+    def emit(self, event, payload=None, room=None):
+        slot_for = EMIT_SLOTS.get(event)
+        with self._lock:
+            pending = self._rooms.setdefault(room, {})
+            if slot_for is None:
+                self._sequence += 1
+                key = (event, self._sequence)
+            else:
+                key = slot_for(payload)
+                previous = pending.pop(key, None)
+                if previous is not None and event in EMIT_MERGES:
+                    payload = EMIT_MERGES[event](previous[1], payload)
+            pending[key] = (event, payload)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        socketio.start_background_task(self._flush_later)
+
+    def _flush_later(self):
+        socketio.sleep(self.tick_seconds)
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            rooms, self._rooms = self._rooms, {}
+            self._scheduled = False
+        for room, pending in rooms.items():
+            socketio.emit("batch", [[event, payload] for event, payload in pending.values()], to=room)
+
+broker = EmitBroker(EMIT_TICK_SECONDS)
+
+# ---------- Roster cache ----------
+CHARACTER_FIELDS = ("id", "name", "role_tag", "bio", "avatar_emoji", "is_alive", "suspect_score", "balance", "login_code")
+
+class RosterEntry:
+    """One cached characters row; supports both c.name and c["name"] like sqlite3.Row."""
+
+    __slots__ = CHARACTER_FIELDS
+
+    def __init__(self, row):
+        for field in CHARACTER_FIELDS:
+            setattr(self, field, row[field])
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+class Roster:
+    """Process-wide copy of the characters table.
+
+    Loaded once, then kept current by write jobs through on_commit() so reads
+    never go back to SQLite. The dead count is maintained alongside it, which
+    makes the phase-two check O(1). The generation moves whenever who is in
+    the game or who is alive changes (seed, kill, revive); session identity
+    snapshots are revalidated only when it does.
+    """
+
+    def __init__(self):
+        self._by_id = None
+        self._dead_count = 0
+        self.generation = 0
+
+    def reload(self, conn=None):
+        conn = conn or get_db()
+        rows = conn.execute("SELECT * FROM characters ORDER BY id").fetchall()
+        by_id = {row["id"]: RosterEntry(row) for row in rows}
+        self._dead_count = sum(1 for entry in by_id.values() if not entry.is_alive)
+        self._by_id = by_id
+        self.generation += 1
+
+    def _entries(self):
+        if self._by_id is None:
+            self.reload()
+        return self._by_id
+
+    def get(self, char_id):
+        return self._entries().get(char_id)
+
+    def find_by_login_code(self, code):
+        for entry in self._entries().values():
+            if entry.login_code.upper() == code:
+                return entry
         return None
-    conn = get_db()
-    char = conn.execute("SELECT * FROM characters WHERE id = ?", (char_id,)).fetchone()
-    conn.close()
-    if char is None:
-        session.pop("character_id", None)
-    return char
 
-def is_phase_two(conn=None):
-    owns_conn = False
-    if conn is None:
+    def board_order(self):
+        # Same order as ORDER BY is_alive DESC, suspect_score DESC, id ASC.
+        return sorted(self._entries().values(), key=lambda c: (-c.is_alive, -c.suspect_score, c.id))
+
+    def gm_order(self):
+        return sorted(self._entries().values(), key=lambda c: (-c.is_alive, c.name))
+
+    @property
+    def phase_two(self):
+        self._entries()
+        return self._dead_count > 0
+
+    def set_alive(self, char_id, is_alive, suspect_score=None):
+        entry = self.get(char_id)
+        if entry is None:
+            return
+        is_alive = int(bool(is_alive))
+        if entry.is_alive != is_alive:
+            self._dead_count += -1 if is_alive else 1
+            entry.is_alive = is_alive
+            self.generation += 1
+        if suspect_score is not None:
+            entry.suspect_score = suspect_score
+
+    def set_score(self, char_id, suspect_score):
+        entry = self.get(char_id)
+        if entry is not None:
+            entry.suspect_score = suspect_score
+
+    def adjust_balance(self, char_id, delta):
+        entry = self.get(char_id)
+        if entry is not None:
+            entry.balance += delta
+
+    def clear(self):
+        self._by_id = None
+        self._dead_count = 0
+        self.generation += 1
+
+roster = Roster()
+
+def transfer_cached_balance(from_id, to_id, amount):
+    roster.adjust_balance(from_id, -amount)
+    roster.adjust_balance(to_id, amount)
+
+# ---------- Suspect leaderboard ----------
+# Heat is the points a character picked up over the last window; total score
+# still decides the board order.
+RECENT_ACCUSATIONS_SQL = """
+    SELECT id, accused_id, points, CAST(strftime('%s', ts) AS INTEGER) AS epoch
+    FROM accusations
+    WHERE ts >= datetime('now', ?)
+    ORDER BY ts
+"""
+
+WINDOW_HEAT_SQL = """
+    SELECT accused_id, SUM(points) AS heat
+    FROM accusations
+    WHERE ts >= datetime('now', ?)
+    GROUP BY accused_id
+"""
+
+class Leaderboard:
+    """The suspect board, kept in rank order as accusations and deaths land.
+
+    Each change moves one character with a bisect instead of re-sorting the
+    roster, and reports only the characters whose rank, score, heat or status
+    moved. Recent accusations sit in a deque so heat expires without a query;
+    a background task checks it every expiry_tick_seconds and pushes the
+    characters whose heat dropped, so the TV's heat stays live between
+    accusations.
+    """
+
+    def __init__(self, heat_window_seconds, expiry_tick_seconds):
+        self.heat_window_seconds = heat_window_seconds
+        self.expiry_tick_seconds = expiry_tick_seconds
+        self._lock = threading.Lock()
+        self._expiry_started = False
+        self._order = None
+        self._keys = []
+        self._recent = deque()
+        self._heat = {}
+        self._loaded_through = 0
+
+    @staticmethod
+    def _key(entry):
+        # Same order as ORDER BY is_alive DESC, suspect_score DESC, id ASC.
+        return (-entry.is_alive, -entry.suspect_score, entry.id)
+
+    def _ensure_loaded(self):
+        if self._order is not None:
+            return
+        entries = roster.board_order()
+        self._keys = [self._key(entry) for entry in entries]
+        self._recent = deque()
+        self._heat = {}
+        self._loaded_through = 0
+        for row in get_db().execute(RECENT_ACCUSATIONS_SQL, (f"-{self.heat_window_seconds} seconds",)):
+            self._add_heat(row["epoch"], row["accused_id"], row["points"])
+            self._loaded_through = max(self._loaded_through, row["id"])
+        self._order = [entry.id for entry in entries]
+        if not self._expiry_started:
+            self._expiry_started = True
+            socketio.start_background_task(self._run_expiry)
+
+    def _add_heat(self, at, char_id, points):
+        self._recent.append((at, char_id, points))
+        self._heat[char_id] = self._heat.get(char_id, 0) + points
+
+    def _expire(self, now):
+        expired = set()
+        cutoff = now - self.heat_window_seconds
+        while self._recent and self._recent[0][0] < cutoff:
+            _, char_id, points = self._recent.popleft()
+            self._heat[char_id] -= points
+            expired.add(char_id)
+        return expired
+
+    def _row(self, rank, char_id):
+        entry = roster.get(char_id)
+        return {
+            "character_id": char_id,
+            "rank": rank,
+            "score": entry.suspect_score,
+            "heat": self._heat.get(char_id, 0),
+            "is_alive": bool(entry.is_alive),
+        }
+
+    def update(self, char_ids, accused_id=None, points=0, accusation_id=None):
+        """Re-rank char_ids from the roster and return what changed."""
+        now = time.time()
+        with self._lock:
+            self._ensure_loaded()
+            touched = self._expire(now)
+            if accused_id is not None:
+                # Updates run after commit, so a cold load may already have read this accusation.
+                if accusation_id is None or accusation_id > self._loaded_through:
+                    self._add_heat(now, accused_id, points)
+                touched.add(accused_id)
+            lo, hi = len(self._order), -1
+            for char_id in char_ids:
+                entry = roster.get(char_id)
+                if entry is None or char_id not in self._order:
+                    continue
+                touched.add(char_id)
+                old = self._order.index(char_id)
+                del self._order[old], self._keys[old]
+                key = self._key(entry)
+                new = bisect.bisect_left(self._keys, key)
+                self._keys.insert(new, key)
+                self._order.insert(new, char_id)
+                lo, hi = min(lo, old, new), max(hi, old, new)
+            # Everything between the old and new slots shifted by one rank.
+            touched.update(self._order[lo:hi + 1])
+            return [self._row(rank, char_id) for rank, char_id in enumerate(self._order, 1) if char_id in touched]
+
+    def expire(self, now=None):
+        """Drop heat that has left the window and return the rows that changed."""
+        with self._lock:
+            if self._order is None:
+                return []
+            expired = self._expire(time.time() if now is None else now)
+            return [self._row(rank, char_id) for rank, char_id in enumerate(self._order, 1) if char_id in expired]
+
+    def _run_expiry(self):
+        while True:
+            socketio.sleep(self.expiry_tick_seconds)
+            try:
+                changes = self.expire()
+            except Exception:
+                app.logger.exception("Suspect heat expiry failed")
+                continue
+            if changes:
+                broker.emit("leaderboard", {"changes": changes})
+
+    def snapshot(self):
+        with self._lock:
+            self._ensure_loaded()
+            self._expire(time.time())
+            return [self._row(rank, char_id) for rank, char_id in enumerate(self._order, 1)]
+
+    def board_order(self):
+        with self._lock:
+            self._ensure_loaded()
+            return [roster.get(char_id) for char_id in self._order]
+
+    def heat_for_window(self, window_seconds):
+        """Heat over an arbitrary window; the configured one is served from memory."""
+        if window_seconds == self.heat_window_seconds:
+            with self._lock:
+                self._ensure_loaded()
+                self._expire(time.time())
+                return dict(self._heat)
+        rows = get_db().execute(WINDOW_HEAT_SQL, (f"-{window_seconds} seconds",)).fetchall()
+        return {row["accused_id"]: row["heat"] for row in rows}
+
+    def clear(self):
+        with self._lock:
+            self._order = None
+            self._keys = []
+            self._recent = deque()
+            self._heat = {}
+            self._loaded_through = 0
+
+SUSPECT_HEAT_TICK_SECONDS = 1
+
+leaderboard = Leaderboard(SUSPECT_HEAT_WINDOW_SECONDS, SUSPECT_HEAT_TICK_SECONDS)
+
+def publish_leaderboard(char_ids, accused_id=None, points=0, accusation_id=None):
+    """on_commit helper: apply a board change and send the TV only the deltas."""
+    changes = leaderboard.update(char_ids, accused_id, points, accusation_id)
+    if changes:
+        broker.emit("leaderboard", {"changes": changes})
+
+# ---------- Feed cache ----------
+FEED_CACHE_SIZE = 200
+
+class FeedEntry:
+    __slots__ = ("id", "pinned", "payload", "json")
+
+    def __init__(self, payload):
+        self.id = payload["id"]
+        self.pinned = payload["pinned"]
+        self.payload = payload
+        self.json = app.json.dumps(payload)
+
+class FeedCache:
+    """The most recent public messages, serialized once.
+
+    Unpinned posts live in a bounded ring buffer; pinned ones are kept apart so
+    they never fall off the end. The cache loads lazily, is appended to by the
+    write jobs that post, and is cleared whenever the feed is wiped.
+    """
+
+    def __init__(self, size=FEED_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=size)
+        self._pinned = []
+        self._loaded = False
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
         conn = get_db()
-        owns_conn = True
-    row = conn.execute("SELECT COUNT(*) AS cnt FROM characters WHERE is_alive = 0").fetchone()
-    if owns_conn:
-        conn.close()
-    return bool(row and row["cnt"] > 0)
+        pinned = conn.execute(PUBLIC_FEED_PINNED_SQL).fetchall()
+        recent = conn.execute(PUBLIC_FEED_RECENT_SQL, (self._recent.maxlen,)).fetchall()
+        self._pinned = [FeedEntry(serialize_public_message(r)) for r in pinned]
+        self._recent.clear()
+        self._recent.extend(FeedEntry(serialize_public_message(r)) for r in reversed(recent))
+        self._loaded = True
+
+    def _complete(self):
+        # Until the ring buffer has overflowed it holds every unpinned post.
+        return len(self._recent) < self._recent.maxlen
+
+    def append(self, entry):
+        with self._lock:
+            if not self._loaded:
+                return
+            if entry.pinned:
+                if all(e.id != entry.id for e in self._pinned):
+                    self._pinned.append(entry)
+            elif not self._recent or entry.id > self._recent[-1].id:
+                self._recent.append(entry)
+
+    def clear(self):
+        with self._lock:
+            self._recent.clear()
+            self._pinned = []
+            self._loaded = True
+
+    def snapshot(self, limit):
+        """Pinned first, then newest first. Returns (entries, has_more)."""
+        with self._lock:
+            self._ensure_loaded()
+            pinned = sorted(self._pinned, key=lambda e: (e.payload["ts"], e.id), reverse=True)
+            entries = pinned + list(reversed(self._recent))
+        return entries[:limit], len(entries) > limit
+
+    def since(self, since_id, limit):
+        """Entries newer than since_id, newest first, or None if the cache can't tell."""
+        with self._lock:
+            self._ensure_loaded()
+            if not self._complete() and since_id < self._recent[0].id:
+                return None
+            entries = [e for e in self._pinned if e.id > since_id]
+            entries.extend(e for e in self._recent if e.id > since_id)
+        if len(entries) > limit:
+            return None
+        return sorted(entries, key=lambda e: e.id, reverse=True)
+
+    def before(self, before_id, limit):
+        """Up to limit entries older than before_id as (entries, has_more), or None."""
+        with self._lock:
+            self._ensure_loaded()
+            entries = [e for e in self._pinned if e.id < before_id]
+            entries.extend(e for e in self._recent if e.id < before_id)
+            complete = self._complete()
+        if len(entries) <= limit and not complete:
+            return None
+        entries.sort(key=lambda e: e.id, reverse=True)
+        return entries[:limit], len(entries) > limit
+
+feed_cache = FeedCache()
+
+# ---------- Unread counters ----------
+DM_UNREAD_TOTAL_SQL = """
+    SELECT COALESCE(SUM(unread_count), 0) AS cnt
+    FROM dm_threads
+    WHERE owner_id = ?
+"""
+
+WALLET_UNREAD_TOTAL_SQL = """
+    SELECT
+        (SELECT COUNT(*) FROM wallet_requests
+         WHERE target_id = ? AND status = 'pending' AND request_type = 'request')
+      + (SELECT COUNT(*) FROM wallet_notifications
+         WHERE recipient_id = ? AND status = 'unread') AS cnt
+"""
+
+class UnreadCounters:
+    """Per-character badge counts ("dm" and "wallet") kept in memory.
+
+    A character's counts are loaded from the durable rows (dm_threads and the
+    wallet tables) the first time they are needed; after that write jobs
+    adjust them through bump_unread() and every change is pushed to the
+    character's room as an unread_counts event.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def get(self, character_id):
+        with self._lock:
+            counts = self._counts.get(character_id)
+            if counts is not None:
+                return dict(counts)
+        # Holding off commits means a write lands either in the rows read here
+        # or in an adjust() that runs after the counts are in place.
+        with db_writer.commit_lock, self._lock:
+            counts = self._counts.get(character_id)
+            if counts is None:
+                conn = get_db()
+                counts = {
+                    "dm": conn.execute(DM_UNREAD_TOTAL_SQL, (character_id,)).fetchone()["cnt"],
+                    "wallet": conn.execute(WALLET_UNREAD_TOTAL_SQL, (character_id, character_id)).fetchone()["cnt"],
+                }
+                self._counts[character_id] = counts
+            return dict(counts)
+
+    def adjust(self, character_id, kind, delta):
+        with self._lock:
+            counts = self._counts.get(character_id)
+            # Not loaded yet: the next get() reads the committed rows anyway.
+            if counts is None:
+                return
+            counts[kind] = max(counts[kind] + delta, 0)
+            payload = dict(counts)
+        broker.emit("unread_counts", payload, room=f"char-{character_id}")
+
+    def clear(self):
+        with self._lock:
+            self._counts = {}
+
+unread_counters = UnreadCounters()
+
+def bump_unread(character_id, kind, delta):
+    """Write job helper: adjust a badge count once the job commits."""
+    if delta:
+        on_commit(lambda: unread_counters.adjust(character_id, kind, delta))
+
+# ---------- Rate limits ----------
+RATE_LIMIT_ROW_SQL = "SELECT tokens, updated_at FROM rate_limits WHERE character_id = ? AND action = ?"
+
+# Refill and spend in one statement; no row comes back when the bucket is empty.
+RATE_LIMIT_TAKE_SQL = """
+    INSERT INTO rate_limits (character_id, action, tokens, updated_at)
+    VALUES (:character_id, :action, :capacity - 1, :now)
+    ON CONFLICT (character_id, action) DO UPDATE SET
+        tokens = MIN(:capacity, tokens + (:now - updated_at) / :refill_seconds) - 1,
+        updated_at = :now
+    WHERE MIN(:capacity, tokens + (:now - updated_at) / :refill_seconds) >= 1
+    RETURNING tokens, updated_at
+"""
+
+class RateLimiter:
+    """Per-character token buckets for player actions.
+
+    The buckets live in SQLite, so they survive restarts and are shared by
+    every server process; spending a token is one conditional upsert inside
+    the action's own write job, so an action that fails or rolls back does not
+    cost a token. Cooldown reads are a primary key lookup on the same table,
+    so they see a spend from any process.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+
+    def remaining(self, character_id, action, conn=None):
+        """Seconds until the next token, 0 if one is available now."""
+        limit = self.limits.get(action)
+        if limit is None:
+            return 0
+        row = (conn or get_db()).execute(RATE_LIMIT_ROW_SQL, (character_id, action)).fetchone()
+        if row is None:
+            return 0
+        tokens, updated_at = row["tokens"], row["updated_at"]
+        level = min(limit["capacity"], tokens + (time.time() - updated_at) / limit["refill_seconds"])
+        return 0 if level >= 1 else math.ceil((1 - level) * limit["refill_seconds"])
+
+    def take(self, conn, character_id, action):
+        """Write job helper: spend one token; False when the bucket is empty."""
+        limit = self.limits.get(action)
+        if limit is None:
+            return True
+        row = conn.execute(RATE_LIMIT_TAKE_SQL, dict(limit, character_id=character_id, action=action, now=time.time())).fetchone()
+        return row is not None
+
+rate_limiter = RateLimiter(RATE_LIMITS)
+
+def rate_limit_error(conn, character_id, action):
+    """Write job helper: spend a token for action, or say how long to wait.
+
+    Call it after the job's checks and before its inserts.
+    """
+    if rate_limiter.take(conn, character_id, action):
+        return None
+    return f"Slow down! Try again in {rate_limiter.remaining(character_id, action, conn)}s."
+
+# ---------- Conditional GET ----------
+class ResourceVersions:
+    """Change counters behind the ETags of the polled JSON endpoints.
+
+    Mutations bump a resource once their write commits, so a poll whose
+    If-None-Match still carries the current version is answered with a 304
+    without touching the database. The boot id stops ETags handed out by a
+    previous process from matching after a restart.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+        self.boot_id = uuid.uuid4().hex[:8]
+
+    def bump(self, *names):
+        with self._lock:
+            for name in names:
+                self._versions[name] = self._versions.get(name, 0) + 1
+
+    def etag(self, name, variant=b""):
+        tag = f"{self.boot_id}-{name}-{self._versions.get(name, 0)}"
+        if variant:
+            tag += f"-{zlib.crc32(variant):08x}"
+        return tag
+
+resource_versions = ResourceVersions()
+
+def touch_resources(*names):
+    """Write job helper: invalidate the named resources once the job commits."""
+    on_commit(lambda: resource_versions.bump(*names))
+
+def conditional_json(resource, build):
+    """jsonify(build()) behind an ETag; build only runs when the client is stale.
+
+    build may also return a ready-made response.
+    """
+    # Read the version before building so a concurrent write can only make the
+    # tag older than the body, never newer.
+    etag = resource_versions.etag(resource, request.query_string)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        body = build()
+        response = body if isinstance(body, app.response_class) else jsonify(body)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+# ---------- Session identity ----------
+# The session cookie (signed with app.secret_key) carries a small snapshot of
+# who is logged in, stamped with the roster generation and this process's boot
+# id. While the stamp is current the snapshot is trusted as is; after a seed,
+# kill, revive or restart it is checked against the roster once and re-stamped.
+IDENTITY_VERSION = 1
+
+def roster_stamp():
+    return f"{resource_versions.boot_id}.{roster.generation}"
+
+def remember_identity(character):
+    session["identity"] = {
+        "v": IDENTITY_VERSION,
+        "id": character["id"],
+        "name": character["name"],
+        "avatar": character["avatar_emoji"],
+        "stamp": roster_stamp(),
+    }
+
+def forget_identity():
+    session.pop("identity", None)
+    session.pop("character_id", None)
+
+def current_identity():
+    """The logged-in player's {id, name, avatar}, or None."""
+    snapshot = session.get("identity")
+    if not snapshot or snapshot.get("v") != IDENTITY_VERSION:
+        # Sessions from before snapshots only carried the id.
+        char_id = session.get("character_id")
+        snapshot = {"id": char_id, "name": None} if char_id else None
+        if snapshot is None:
+            return None
+    elif snapshot["stamp"] == roster_stamp():
+        return snapshot
+    char = roster.get(snapshot["id"])
+    # A reseed reuses ids, so the name has to match as well.
+    if char is None or (snapshot["name"] is not None and char["name"] != snapshot["name"]):
+        forget_identity()
+        return None
+    session.pop("character_id", None)
+    remember_identity(char)
+    return session["identity"]
+
+# ---------- Helpers ----------
+def get_logged_in_character():
+    identity = current_identity()
+    return roster.get(identity["id"]) if identity else None
+
+def is_phase_two():
+    return roster.phase_two
+
+def count_dead(conn):
+    return conn.execute("SELECT COUNT(*) AS cnt FROM characters WHERE is_alive = 0").fetchone()["cnt"]
+
+PUBLIC_FEED_PINNED_SQL = """
+    SELECT m.*, c.name AS sender_name, c.avatar_emoji
+    FROM messages m
+    LEFT JOIN characters c ON m.sender_id = c.id
+    WHERE m.type = 'public' AND m.pinned = 1
+    ORDER BY m.ts, m.id
+"""
+
+PUBLIC_FEED_RECENT_SQL = """
+    SELECT m.*, c.name AS sender_name, c.avatar_emoji
+    FROM messages m
+    LEFT JOIN characters c ON m.sender_id = c.id
+    WHERE m.type = 'public' AND m.pinned = 0
+    ORDER BY m.ts DESC, m.id DESC
+    LIMIT ?
+"""
+
+PUBLIC_MESSAGE_SQL = """
+    SELECT m.*, c.name AS sender_name, c.avatar_emoji
+    FROM messages m
+    LEFT JOIN characters c ON m.sender_id = c.id
+    WHERE m.id = ?
+"""
 
 def fetch_public_messages(limit=50):
-    conn = get_db()
-    rows = conn.execute("""
-        SELECT m.*, c.name AS sender_name, c.avatar_emoji
-        FROM messages m
-        LEFT JOIN characters c ON m.sender_id = c.id
-        WHERE m.type = 'public'
-        ORDER BY m.pinned DESC, m.ts DESC, m.id DESC
-        LIMIT ?
-    """, (limit,)).fetchall()
-    conn.close()
-    return rows
+    entries, _ = feed_cache.snapshot(limit)
+    return [e.payload for e in entries]
+
+def publish_public_message(conn, message_id):
+    """Write job helper: add a freshly inserted public message to the feed.
+
+    Returns its FeedEntry; the cache and then the feed ETag are updated on commit.
+    """
+    entry = FeedEntry(serialize_public_message(conn.execute(PUBLIC_MESSAGE_SQL, (message_id,)).fetchone()))
+
+    def publish():
+        # Cache first: a poll must never pair the new ETag with the old body.
+        feed_cache.append(entry)
+        resource_versions.bump("feed")
+    on_commit(publish)
+    return entry
 
 def serialize_public_message(row):
     system_author = SCHOOL_NAME
@@ -322,6 +1419,80 @@ def serialize_public_message(row):
         "pinned": bool(row["pinned"]) if "pinned" in row.keys() else False,
     }
 
+PUBLIC_FEED_BEFORE_SQL = """
+    SELECT m.*, c.name AS sender_name, c.avatar_emoji
+    FROM messages m
+    LEFT JOIN characters c ON m.sender_id = c.id
+    WHERE m.type = 'public' AND m.id < ?
+    ORDER BY m.id DESC
+    LIMIT ?
+"""
+
+FEED_PAGE_SIZE = 50
+_feed_epoch = None
+
+def get_feed_epoch():
+    """Token that changes whenever the public feed is wiped (clear or reseed).
+
+    Clients holding a different epoch must drop what they have and reload.
+    """
+    global _feed_epoch
+    if _feed_epoch is None:
+        row = get_db().execute("SELECT value FROM app_state WHERE key = 'feed_epoch'").fetchone()
+        if row:
+            _feed_epoch = row["value"]
+        else:
+            db_write(bump_feed_epoch)
+    return _feed_epoch
+
+def bump_feed_epoch(conn):
+    """Write job helper: start a new, empty feed epoch once the surrounding job commits."""
+    epoch = uuid.uuid4().hex[:12]
+    conn.execute("INSERT OR REPLACE INTO app_state (key, value) VALUES ('feed_epoch', ?)", (epoch,))
+
+    def publish():
+        global _feed_epoch
+        _feed_epoch = epoch
+        feed_cache.clear()
+        resource_versions.bump("feed")
+    on_commit(publish)
+
+def fetch_public_feed_page(since_id=None, before_id=None, limit=FEED_PAGE_SIZE, epoch=None):
+    """Return one /api/messages page with FeedEntry messages.
+
+    since_id returns only newer posts and before_id pages back through older
+    ones, both newest first. Without a cursor, or when the client's epoch is
+    stale, the full pinned-first snapshot comes back with reset set. Reads are
+    served from feed_cache; only paging past its end touches the database.
+    """
+    current_epoch = get_feed_epoch()
+    if epoch and epoch != current_epoch:
+        since_id = before_id = None
+    if since_id is not None:
+        entries = feed_cache.since(since_id, limit)
+        # Too far behind to patch incrementally: fall through to a fresh snapshot.
+        if entries is not None:
+            return {"epoch": current_epoch, "reset": False, "has_more": False, "messages": entries}
+    elif before_id is not None:
+        cached = feed_cache.before(before_id, limit)
+        if cached is None:
+            rows = get_db().execute(PUBLIC_FEED_BEFORE_SQL, (before_id, limit + 1)).fetchall()
+            cached = [FeedEntry(serialize_public_message(r)) for r in rows[:limit]], len(rows) > limit
+        entries, has_more = cached
+        return {"epoch": current_epoch, "reset": False, "has_more": has_more, "messages": entries}
+    entries, has_more = feed_cache.snapshot(limit)
+    return {"epoch": current_epoch, "reset": True, "has_more": has_more, "messages": entries}
+
+def feed_page_response(page):
+    """Render a feed page by splicing together the entries' cached JSON."""
+    body = '{"epoch":%s,"has_more":%s,"messages":[%s],"reset":%s}' % (
+        json.dumps(page["epoch"]),
+        json.dumps(page["has_more"]),
+        ",".join(e.json for e in page["messages"]),
+        json.dumps(page["reset"]),
+    )
+    return app.response_class(body, mimetype="application/json")
+
 def parse_amount(raw_value):
     try:
         value = int(raw_value)
@@ -331,174 +1502,230 @@ def parse_amount(raw_value):
         return None
     return value
 
-def settle_pending_sends(conn, target_id):
-    rows = conn.execute("""
-        SELECT * FROM wallet_requests
-        WHERE target_id = ? AND status = 'pending' AND request_type = 'send'
-    """, (target_id,)).fetchall()
-    for row in rows:
-        sender_balance = conn.execute("SELECT balance FROM characters WHERE id = ?", (row["requester_id"],)).fetchone()["balance"]
-        if row["amount"] > sender_balance:
-            conn.execute("""
-                UPDATE wallet_requests
-                SET status = 'declined', responded_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            """, (row["id"],))
-            continue
-        conn.execute("UPDATE characters SET balance = balance - ? WHERE id = ?", (row["amount"], row["requester_id"]))
-        conn.execute("UPDATE characters SET balance = balance + ? WHERE id = ?", (row["amount"], target_id))
-        conn.execute("""
-            UPDATE wallet_requests
-            SET status = 'accepted', responded_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        """, (row["id"],))
-        conn.execute("""
-            INSERT INTO wallet_notifications (sender_id, recipient_id, amount, status)
-            VALUES (?, ?, ?, 'unread')
-        """, (row["requester_id"], target_id, row["amount"]))
-
-def get_song_catalog():
-    if not JUKEBOX_DIR.exists():
-        return []
-    songs = []
-    for path in JUKEBOX_DIR.iterdir():
-        if not path.is_file():
-            continue
-        if path.suffix.lower() not in {".mp3", ".wav", ".ogg"}:
-            continue
-        stem = path.stem
-        if " - " in stem:
-            artist, title = stem.split(" - ", 1)
-        else:
-            artist = "Unknown"
-            title = stem
-        songs.append({
-            "filename": path.name,
-            "title": title.strip(),
-            "artist": artist.strip(),
-        })
-    songs.sort(key=lambda s: (s["artist"].lower(), s["title"].lower()))
-    return [s for s in songs if s["filename"] != THRILLER_FILENAME]
-
-def get_current_playing(conn):
-    return conn.execute("""
-        SELECT q.*, c.name AS requester_name
-        FROM jukebox_queue q
-        LEFT JOIN characters c ON q.requester_id = c.id
-        WHERE q.status = 'playing'
-        ORDER BY q.started_at DESC, q.id DESC
-        LIMIT 1
-    """).fetchone()
-
-def ensure_now_playing(conn):
-    current = get_current_playing(conn)
-    if current:
-        return current
-    next_row = conn.execute("""
-        SELECT *
-        FROM jukebox_queue
-        WHERE status = 'queued'
-        ORDER BY priority DESC, requested_at ASC, id ASC
-        LIMIT 1
-    """).fetchone()
-    if not next_row:
-        return None
-    conn.execute("""
-        UPDATE jukebox_queue
-        SET status = 'playing', started_at = CURRENT_TIMESTAMP
-        WHERE id = ?
-    """, (next_row["id"],))
-    conn.commit()
-    return get_current_playing(conn)
-
-def serialize_now_playing(row):
+# ---------- Wallet events ----------
+# What each player's wallet tab hears about: 'sent', 'received', 'request' (someone
+# asked them for money) and 'declined' (their request or queued send was turned
+# down). Rows are pushed to char-<id> as they commit and replayed on reconnect.
+WALLET_CATCHUP_LIMIT = 100
+
+WALLET_EVENTS_SINCE_SQL = """
+    SELECT * FROM wallet_events
+    WHERE character_id = ? AND id > ?
+    ORDER BY id
+    LIMIT ?
+"""
+
+WALLET_LAST_EVENT_SQL = "SELECT COALESCE(MAX(id), 0) FROM wallet_events WHERE character_id = ?"
+
+def serialize_wallet_event(row):
+    # The balance is read when the event goes out, so a replay reports the current one.
+    character = roster.get(row["character_id"])
     return {
-        "queue_id": row["id"],
-        "filename": row["song_filename"],
-        "title": row["song_title"],
-        "artist": row["song_artist"],
-        "requester": row["requester_name"] or "Unknown",
+        "id": row["id"],
+        "kind": row["kind"],
+        "other_id": row["other_id"],
+        "amount": row["amount"],
+        "request_id": row["request_id"],
+        "balance": character["balance"] if character else 0,
     }
 
-def get_up_next(conn, limit=2):
-    rows = conn.execute("""
-        SELECT q.*, c.name AS requester_name
-        FROM jukebox_queue q
-        LEFT JOIN characters c ON q.requester_id = c.id
-        WHERE q.status = 'queued'
-        ORDER BY q.priority DESC, q.requested_at ASC, q.id ASC
-        LIMIT ?
-    """, (limit,)).fetchall()
-    return rows
+def emit_wallet_events(rows):
+    for row in rows:
+        broker.emit("wallet_event", serialize_wallet_event(row), room=f"char-{row['character_id']}")
 
-def enqueue_song(filename, requester_id, priority=0, conn=None):
-    owns_conn = False
-    if conn is None:
-        conn = get_db()
-        owns_conn = True
-    songs = get_song_catalog()
-    song = next((s for s in songs if s["filename"] == filename), None)
-    if not song:
-        if filename == THRILLER_FILENAME:
-            stem = Path(filename).stem
-            if " - " in stem:
-                artist, title = stem.split(" - ", 1)
-            else:
-                artist, title = "Unknown", stem
-            song = {"filename": filename, "title": title.strip(), "artist": artist.strip()}
-        else:
-            if owns_conn:
-                conn.close()
-            return None
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO jukebox_queue (song_filename, song_title, song_artist, requester_id, status, priority)
-        VALUES (?, ?, ?, ?, 'queued', ?)
-    """, (filename, song["title"], song["artist"], requester_id, priority))
-    conn.commit()
-    queue_id = cur.lastrowid
-    if owns_conn:
-        conn.close()
-    return queue_id
-
-def force_play_thriller(conn, requester_id):
-    # Prefer an existing queued/playing thriller, otherwise enqueue a fresh one with max priority.
+def record_wallet_event(conn, character_id, kind, other_id, amount, request_id=None):
+    """Write job helper: store a wallet event and push it once the job commits."""
     row = conn.execute("""
-        SELECT *
-        FROM jukebox_queue
-        WHERE song_filename = ? AND status IN ('queued', 'playing')
-        ORDER BY priority DESC, requested_at DESC, id DESC
-        LIMIT 1
-    """, (THRILLER_FILENAME,)).fetchone()
-    if row:
-        target_id = row["id"]
-    else:
-        target_id = enqueue_song(THRILLER_FILENAME, requester_id=requester_id, priority=999, conn=conn)
-
-    current = get_current_playing(conn)
-    if current and current["id"] != target_id:
-        conn.execute("""
-            UPDATE jukebox_queue
-            SET status = 'skipped', ended_at = CURRENT_TIMESTAMP
-            WHERE id = ? AND status = 'playing'
-        """, (current["id"],))
+        INSERT INTO wallet_events (character_id, kind, other_id, amount, request_id)
+        VALUES (?, ?, ?, ?, ?)
+        RETURNING *
+    """, (character_id, kind, other_id, amount, request_id)).fetchone()
+    on_commit(lambda: emit_wallet_events([row]))
+
+def last_wallet_event_id(character_id):
+    return get_db().execute(WALLET_LAST_EVENT_SQL, (character_id,)).fetchone()[0]
+
+# ---------- Wallet ledger ----------
+def has_balance(conn, character_id, amount):
+    """Write job helper: whether character_id can afford amount right now."""
+    row = conn.execute("SELECT balance FROM characters WHERE id = ?", (character_id,)).fetchone()
+    return row is not None and row["balance"] >= amount
+
+def ledger_transfer(conn, from_id, to_id, amount, kind, request_id=None):
+    """Write job helper: move amount between two characters.
+
+    The debit is a single guarded UPDATE, so an overdraft changes nothing and
+    returns False. Otherwise both balances move, the ledger gets its row, both
+    sides get a wallet event and the roster follows once the batch commits.
+    """
+    debited = conn.execute(
+        "UPDATE characters SET balance = balance - ? WHERE id = ? AND balance >= ?",
+        (amount, from_id, amount),
+    ).rowcount
+    if not debited:
+        return False
+    credited = conn.execute("UPDATE characters SET balance = balance + ? WHERE id = ?", (amount, to_id)).rowcount
+    if not credited:
+        # Raising rolls the whole job back, debit included.
+        raise ValueError(f"wallet transfer to unknown character {to_id}")
+    conn.execute("""
+        INSERT INTO wallet_ledger (from_id, to_id, amount, kind, request_id)
+        VALUES (?, ?, ?, ?, ?)
+    """, (from_id, to_id, amount, kind, request_id))
+    on_commit(lambda: transfer_cached_balance(from_id, to_id, amount))
+    record_wallet_event(conn, from_id, "sent", to_id, amount, request_id)
+    record_wallet_event(conn, to_id, "received", from_id, amount, request_id)
+    return True
+
+LEDGER_BALANCES_SQL = """
+    WITH moves AS (
+        SELECT to_id AS id, amount FROM wallet_ledger
+        UNION ALL
+        SELECT from_id, -amount FROM wallet_ledger WHERE from_id IS NOT NULL
+    ),
+    totals AS (
+        SELECT id, SUM(amount) AS ledger_balance FROM moves GROUP BY id
+    )
+    SELECT c.id, c.name, c.balance, COALESCE(t.ledger_balance, 0) AS ledger_balance
+    FROM characters c
+    LEFT JOIN totals t ON t.id = c.id
+    ORDER BY c.id
+"""
+
+def verify_ledger(conn, repair=False):
+    """Replay the ledger and return the characters whose balance disagrees.
+
+    With repair=True the stored balances are overwritten with the replayed
+    ones. A running server keeps its cached balances until it restarts.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        mismatches = [row for row in conn.execute(LEDGER_BALANCES_SQL).fetchall() if row["balance"] != row["ledger_balance"]]
+        if repair:
+            conn.executemany(
+                "UPDATE characters SET balance = ? WHERE id = ?",
+                [(row["ledger_balance"], row["id"]) for row in mismatches],
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return mismatches
+
+PENDING_SENDS_SQL = """
+    SELECT id, requester_id, target_id, amount
+    FROM wallet_requests
+    WHERE status = 'pending' AND request_type = 'send'
+    ORDER BY id
+"""
+
+SETTLEMENT_DELTAS_SQL = """
+    SELECT id, SUM(delta) AS delta FROM (
+        SELECT requester_id AS id, -amount AS delta FROM temp.settlement WHERE covered
+        UNION ALL
+        SELECT target_id, amount FROM temp.settlement WHERE covered
+    )
+    GROUP BY id
+"""
+
+def settle_pending_sends(conn):
+    """Write job: settle every queued 'send' in one pass.
+
+    Sends are walked oldest first against running balances, so a send that
+    does not fit is declined without holding up later ones and money received
+    earlier in the pass can fund later sends. Covered sends move money and
+    leave a ledger row, a notification and a wallet event on each side; the
+    rest are declined and the sender is told. The outcome is then applied in
+    a few set-based statements.
+    """
+    pending = conn.execute(PENDING_SENDS_SQL).fetchall()
+    if not pending:
+        return
+    balances = {row["id"]: row["balance"] for row in conn.execute("SELECT id, balance FROM characters")}
+    rows = []
+    for send in pending:
+        covered = (
+            send["target_id"] in balances
+            and balances.get(send["requester_id"], 0) >= send["amount"]
+        )
+        if covered:
+            balances[send["requester_id"]] -= send["amount"]
+            balances[send["target_id"]] += send["amount"]
+        rows.append((send["id"], send["requester_id"], send["target_id"], send["amount"], int(covered)))
 
+    conn.execute("DROP TABLE IF EXISTS temp.settlement")
     conn.execute("""
-        UPDATE jukebox_queue
-        SET status = 'playing', started_at = CURRENT_TIMESTAMP, priority = 999
-        WHERE id = ?
-    """, (target_id,))
-    conn.commit()
-    # Recalculate now playing row
-    return get_current_playing(conn)
-
-def serialize_queue_row(row):
-    return {
-        "queue_id": row["id"],
-        "title": row["song_title"],
-        "artist": row["song_artist"],
-        "requester": row["requester_name"] or "Unknown",
-    }
+        CREATE TEMP TABLE settlement (
+            id INTEGER PRIMARY KEY, requester_id INTEGER, target_id INTEGER, amount INTEGER, covered INTEGER
+        )
+    """)
+    try:
+        conn.executemany("INSERT INTO temp.settlement VALUES (?, ?, ?, ?, ?)", rows)
+        deltas = conn.execute(SETTLEMENT_DELTAS_SQL).fetchall()
+        conn.executemany(
+            "UPDATE characters SET balance = balance + ? WHERE id = ?",
+            [(row["delta"], row["id"]) for row in deltas],
+        )
+        conn.execute("""
+            INSERT INTO wallet_ledger (from_id, to_id, amount, kind, request_id)
+            SELECT requester_id, target_id, amount, 'send', id FROM temp.settlement WHERE covered ORDER BY id
+        """)
+        conn.execute("""
+            INSERT INTO wallet_notifications (sender_id, recipient_id, amount, status)
+            SELECT requester_id, target_id, amount, 'unread' FROM temp.settlement WHERE covered ORDER BY id
+        """)
+        conn.execute("""
+            UPDATE wallet_requests
+            SET status = CASE WHEN s.covered THEN 'accepted' ELSE 'declined' END,
+                responded_at = CURRENT_TIMESTAMP
+            FROM temp.settlement AS s
+            WHERE wallet_requests.id = s.id
+        """)
+        events = conn.execute("""
+            INSERT INTO wallet_events (character_id, kind, other_id, amount, request_id)
+            SELECT requester_id, CASE WHEN covered THEN 'sent' ELSE 'declined' END, target_id, amount, id
+            FROM temp.settlement
+            UNION ALL
+            SELECT target_id, 'received', requester_id, amount, id FROM temp.settlement WHERE covered
+            ORDER BY 5, 1
+            RETURNING *
+        """).fetchall()
+        events.sort(key=lambda row: row["id"])
+    finally:
+        conn.execute("DROP TABLE temp.settlement")
+
+    for _, _, target_id, _, covered in rows:
+        if covered:
+            bump_unread(target_id, "wallet", 1)
+
+    def publish():
+        for row in deltas:
+            roster.adjust_balance(row["id"], row["delta"])
+        emit_wallet_events(events)
+    on_commit(publish)
+
+PENDING_SENDS_EXIST_SQL = "SELECT 1 FROM wallet_requests WHERE status = 'pending' AND request_type = 'send' LIMIT 1"
+
+def schedule_settlement():
+    """Hand any queued sends to the writer without waiting for the result."""
+    if get_db().execute(PENDING_SENDS_EXIST_SQL).fetchone():
+        submit_write(settle_pending_sends)
+
+WALLET_PENDING_SQL = """
+    SELECT r.*, c.name AS requester_name, c.avatar_emoji AS requester_avatar
+    FROM wallet_requests r
+    JOIN characters c ON r.requester_id = c.id
+    WHERE r.target_id = ? AND r.status = 'pending' AND r.request_type = 'request'
+    ORDER BY r.created_at DESC
+"""
+
+WALLET_NOTIFICATIONS_SQL = """
+    SELECT n.*, c.name AS sender_name, c.avatar_emoji AS sender_avatar
+    FROM wallet_notifications n
+    JOIN characters c ON n.sender_id = c.id
+    WHERE n.recipient_id = ? AND n.status = 'unread'
+    ORDER BY n.created_at DESC
+"""
 
 def get_photostrips(limit=12):
     conn = get_db()
@@ -507,7 +1734,6 @@ def get_photostrips(limit=12):
         ORDER BY created_at DESC, id DESC
         LIMIT ?
     """, (limit,)).fetchall()
-    conn.close()
     strips = []
     for row in rows:
         strips.append({
@@ -537,109 +1763,931 @@ def save_photostrip(images):
         with open(PHOTOBOOTH_DIR / filename, "wb") as f:
             f.write(binary)
         filenames.append(filename)
-    conn = get_db()
-    conn.execute("""
-        INSERT INTO photostrips (img1, img2, img3, img4)
-        VALUES (?, ?, ?, ?)
-    """, (filenames[0], filenames[1], filenames[2], filenames[3]))
-    conn.commit()
-    strip_id = conn.execute("SELECT last_insert_rowid() AS id").fetchone()["id"]
-    conn.close()
+    def insert_strip(conn):
+        touch_resources("photostrips")
+        return conn.execute("""
+            INSERT INTO photostrips (img1, img2, img3, img4)
+            VALUES (?, ?, ?, ?)
+        """, (filenames[0], filenames[1], filenames[2], filenames[3])).lastrowid
+
+    strip_id = db_write(insert_strip)
     return {
         "id": strip_id,
         "images": [f"/static/photobooth/{name}" for name in filenames],
     }
 
+DM_INBOX_SQL = """
+    SELECT other_id, last_message_id, last_body, last_ts, last_sender_id, unread_count
+    FROM dm_threads
+    WHERE owner_id = ?
+"""
+
+DM_THREAD_UNREAD_SQL = """
+    SELECT unread_count
+    FROM dm_threads
+    WHERE owner_id = ? AND other_id = ?
+"""
+
+DM_MESSAGE_SQL = """
+    SELECT m.*, s.name AS sender_name, s.avatar_emoji AS sender_avatar
+    FROM messages m
+    LEFT JOIN characters s ON m.sender_id = s.id
+    WHERE m.id = ?
+"""
+
+UPSERT_DM_THREAD_SQL = """
+    INSERT INTO dm_threads
+        (owner_id, other_id, last_message_id, last_body, last_ts, last_sender_id, unread_count)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (owner_id, other_id) DO UPDATE SET
+        last_message_id = excluded.last_message_id,
+        last_body = excluded.last_body,
+        last_ts = excluded.last_ts,
+        last_sender_id = excluded.last_sender_id,
+        unread_count = unread_count + excluded.unread_count
+"""
+
+# One direction of a conversation; a page is the merge of both directions, so
+# each half is a single seek on idx_messages_dm_page.
+DM_THREAD_PAGE_SQL = """
+    SELECT id, sender_id, body, ts
+    FROM messages
+    WHERE type = 'dm' AND sender_id = ? AND recipient_id = ? AND id < ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+
+DM_PAGE_SIZE = 30
+
+MARK_THREAD_READ_SQL = """
+    UPDATE messages
+    SET is_read = 1
+    WHERE type = 'dm' AND recipient_id = ? AND sender_id = ? AND is_read = 0
+"""
+
 def build_dm_threads(conn, user_id, characters):
+    summaries = {row["other_id"]: row for row in conn.execute(DM_INBOX_SQL, (user_id,)).fetchall()}
     threads = []
     for c in characters:
         if c["id"] == user_id:
             continue
-        last = conn.execute("""
-            SELECT id, body, ts, sender_id
-            FROM messages
-            WHERE type = 'dm' AND (
-                (sender_id = ? AND recipient_id = ?) OR
-                (sender_id = ? AND recipient_id = ?)
-            )
-            ORDER BY ts DESC, id DESC
-            LIMIT 1
-        """, (user_id, c["id"], c["id"], user_id)).fetchone()
-        unread = conn.execute("""
-            SELECT COUNT(*) AS cnt
-            FROM messages
-            WHERE type = 'dm' AND sender_id = ? AND recipient_id = ? AND is_read = 0
-        """, (c["id"], user_id)).fetchone()["cnt"]
-
+        last = summaries.get(c["id"])
         threads.append({
             "other_id": c["id"],
             "name": c["name"],
             "avatar_emoji": c["avatar_emoji"],
             "role_tag": c["role_tag"],
-            "last_id": last["id"] if last else None,
-            "last_body": last["body"] if last else None,
-            "last_ts": last["ts"] if last else None,
-            "last_sender_id": last["sender_id"] if last else None,
-            "unread_count": unread,
+            "last_id": last["last_message_id"] if last else None,
+            "last_body": last["last_body"] if last else None,
+            "last_ts": last["last_ts"] if last else None,
+            "last_sender_id": last["last_sender_id"] if last else None,
+            "unread_count": last["unread_count"] if last else 0,
         })
 
     threads.sort(key=lambda t: t["last_ts"] or "", reverse=True)
     return threads
 
-def fetch_thread_messages(user_id, other_id):
+def fetch_thread_messages(user_id, other_id, before_id=None, limit=DM_PAGE_SIZE):
+    """One page of a conversation, oldest first, ending just before before_id.
+
+    Returns (messages, has_more); pass the first message's id as before_id to
+    page further back.
+    """
     conn = get_db()
-    rows = conn.execute("""
-        SELECT m.*, s.name AS sender_name, s.avatar_emoji AS sender_avatar
-        FROM messages m
-        LEFT JOIN characters s ON m.sender_id = s.id
-        WHERE m.type = 'dm' AND (
-            (m.sender_id = ? AND m.recipient_id = ?) OR
-            (m.sender_id = ? AND m.recipient_id = ?)
-        )
-        ORDER BY m.ts ASC, m.id ASC
-    """, (user_id, other_id, other_id, user_id)).fetchall()
-    conn.close()
-    return rows
+    before_id = before_id or sys.maxsize
+    rows = conn.execute(DM_THREAD_PAGE_SQL, (user_id, other_id, before_id, limit + 1)).fetchall()
+    rows += conn.execute(DM_THREAD_PAGE_SQL, (other_id, user_id, before_id, limit + 1)).fetchall()
+    rows.sort(key=lambda r: r["id"], reverse=True)
+    messages = [{"id": r["id"], "sender_id": r["sender_id"], "body": r["body"], "ts": r["ts"]} for r in rows[:limit]]
+    messages.reverse()
+    return messages, len(rows) > limit
 
 def mark_thread_read(user_id, other_id):
     conn = get_db()
-    conn.execute("""
-        UPDATE messages
-        SET is_read = 1
-        WHERE type = 'dm' AND recipient_id = ? AND sender_id = ? AND is_read = 0
-    """, (user_id, other_id))
-    conn.commit()
-    conn.close()
+    # Skip the write queue entirely when there is nothing unread.
+    summary = conn.execute(DM_THREAD_UNREAD_SQL, (user_id, other_id)).fetchone()
+    if summary and summary["unread_count"]:
+        def mark_read(wconn):
+            unread = wconn.execute(DM_THREAD_UNREAD_SQL, (user_id, other_id)).fetchone()["unread_count"]
+            wconn.execute(MARK_THREAD_READ_SQL, (user_id, other_id))
+            wconn.execute(
+                "UPDATE dm_threads SET unread_count = 0 WHERE owner_id = ? AND other_id = ?",
+                (user_id, other_id),
+            )
+            bump_unread(user_id, "dm", -unread)
+        db_write(mark_read)
 
-# ---------- Routes ----------
-_db_initialized = False
+def record_dm(conn, sender_id, recipient_id, body):
+    """Write job helper: insert a DM and roll it into both sides' thread summaries."""
+    new_id = conn.execute("""
+        INSERT INTO messages (type, sender_id, recipient_id, body, is_anonymous, is_read)
+        VALUES ('dm', ?, ?, ?, 0, 0)
+    """, (sender_id, recipient_id, body)).lastrowid
+    row = conn.execute(DM_MESSAGE_SQL, (new_id,)).fetchone()
+    conn.execute(UPSERT_DM_THREAD_SQL, (sender_id, recipient_id, new_id, body, row["ts"], sender_id, 0))
+    conn.execute(UPSERT_DM_THREAD_SQL, (recipient_id, sender_id, new_id, body, row["ts"], sender_id, 1))
+    bump_unread(recipient_id, "dm", 1)
+    return row
+
+# ---------- Jukebox catalog ----------
+# Just enough of each container to get a title, artist and duration out of the
+# first and last few KB of a file, without pulling in a tagging library.
+JUKEBOX_SUFFIXES = {".mp3", ".wav", ".ogg"}
+JUKEBOX_CACHE_PATH = APP_DIR / "jukebox_catalog.json"
+AUDIO_PROBE_BYTES = 64 * 1024
+
+MP3_BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MP3_SAMPLE_RATES = (44100, 48000, 32000)
+ID3_TEXT_ENCODINGS = ("latin-1", "utf-16", "utf-16-be", "utf-8")
+ID3_FRAMES = {"TIT2": "title", "TPE1": "artist", "TT2": "title", "TP1": "artist"}
+# Where a duration came from. A frame count, an Ogg granule position or a WAV
+# data size give the real length; "bitrate" is a guess from the first MP3 frame
+# and can be far off for VBR files without a Xing/VBRI header (the browser has
+# to guess the same way for those).
+EXACT_DURATION_SOURCES = {"frames", "granule", "data_size"}
+
+def parse_song_filename(name):
+    stem = Path(name).stem
+    if " - " in stem:
+        artist, title = stem.split(" - ", 1)
+    else:
+        artist, title = "Unknown", stem
+    return artist.strip(), title.strip()
+
+def syncsafe_int(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+def read_id3v2(f):
+    """Return ({title, artist}, offset of the first byte after the tag)."""
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b"ID3":
+        return {}, 0
+    version, flags = header[3], header[5]
+    end = 10 + syncsafe_int(header[6:10]) + (10 if flags & 0x10 else 0)
+    data = f.read(end - 10)
+    tags = {}
+    pos, header_size = 0, (6 if version == 2 else 10)
+    while pos + header_size <= len(data) and data[pos] != 0:
+        if version == 2:
+            frame_id, size = data[pos:pos + 3].decode("latin-1"), int.from_bytes(data[pos + 3:pos + 6], "big")
+        else:
+            frame_id = data[pos:pos + 4].decode("latin-1")
+            raw_size = data[pos + 4:pos + 8]
+            size = syncsafe_int(raw_size) if version == 4 else int.from_bytes(raw_size, "big")
+        body = data[pos + header_size:pos + header_size + size]
+        pos += header_size + size
+        if frame_id in ID3_FRAMES and body and body[0] < len(ID3_TEXT_ENCODINGS):
+            text = body[1:].decode(ID3_TEXT_ENCODINGS[body[0]], errors="replace").strip("\x00").strip()
+            if text:
+                tags[ID3_FRAMES[frame_id]] = text.split("\x00")[0]
+    return tags, end
+
+def read_id3v1(f, file_size):
+    if file_size < 128:
+        return {}
+    f.seek(file_size - 128)
+    data = f.read(128)
+    if data[:3] != b"TAG":
+        return {}
+    fields = {"title": data[3:33], "artist": data[33:63]}
+    return {key: value.split(b"\x00")[0].decode("latin-1").strip() for key, value in fields.items() if value.strip(b"\x00 ")}
+
+def mp3_duration(f, audio_start, audio_end):
+    """(duration, source) from the Xing/VBRI frame count when there is one, else from the bitrate."""
+    f.seek(audio_start)
+    data = f.read(AUDIO_PROBE_BYTES)
+    for i in range(len(data) - 4):
+        if data[i] != 0xFF or (data[i + 1] & 0xE0) != 0xE0:
+            continue
+        version_bits, layer_bits = (data[i + 1] >> 3) & 3, (data[i + 1] >> 1) & 3
+        bitrate_index, rate_index = data[i + 2] >> 4, (data[i + 2] >> 2) & 3
+        if version_bits == 1 or layer_bits != 1 or bitrate_index in (0, 15) or rate_index == 3:
+            continue
+        mpeg1 = version_bits == 3
+        sample_rate = MP3_SAMPLE_RATES[rate_index] >> (0 if mpeg1 else 1 if version_bits == 2 else 2)
+        samples_per_frame = 1152 if mpeg1 else 576
+        mono = (data[i + 3] >> 6) == 3
+        side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+        for marker, offset, count_at in ((b"Xing", 4 + side_info, 8), (b"Info", 4 + side_info, 8), (b"VBRI", 36, 14)):
+            at = i + offset
+            if data[at:at + 4] == marker and (marker == b"VBRI" or data[at + 7] & 1):
+                frames = int.from_bytes(data[at + count_at:at + count_at + 4], "big")
+                if frames:
+                    return frames * samples_per_frame / sample_rate, "frames"
+        bitrate = MP3_BITRATES[1 if mpeg1 else 2][bitrate_index] * 1000
+        return (audio_end - audio_start - i) * 8 / bitrate, "bitrate"
+    return None, None
+
+def read_mp3(f, file_size):
+    tags, audio_start = read_id3v2(f)
+    v1 = read_id3v1(f, file_size)
+    for key, value in v1.items():
+        tags.setdefault(key, value)
+    duration, source = mp3_duration(f, audio_start, file_size - (128 if v1 else 0))
+    return tags, duration, source
+
+def read_ogg(f, file_size):
+    head = f.read(AUDIO_PROBE_BYTES)
+    tags, duration = {}, None
+    ident = head.find(b"\x01vorbis")
+    sample_rate = int.from_bytes(head[ident + 12:ident + 16], "little") if ident >= 0 else 0
+    comments = head.find(b"\x03vorbis")
+    if comments >= 0:
+        pos = comments + 7
+        pos += 4 + int.from_bytes(head[pos:pos + 4], "little")
+        count, pos = int.from_bytes(head[pos:pos + 4], "little"), pos + 4
+        for _ in range(count):
+            length = int.from_bytes(head[pos:pos + 4], "little")
+            key, _, value = head[pos + 4:pos + 4 + length].decode("utf-8", errors="replace").partition("=")
+            pos += 4 + length
+            if key.lower() in ("title", "artist") and value.strip():
+                tags.setdefault(key.lower(), value.strip())
+    if sample_rate:
+        f.seek(max(0, file_size - AUDIO_PROBE_BYTES))
+        tail = f.read()
+        last_page = tail.rfind(b"OggS")
+        if last_page >= 0:
+            duration = int.from_bytes(tail[last_page + 6:last_page + 14], "little") / sample_rate
+    return tags, duration, "granule"
+
+def read_wav(f, file_size):
+    if f.read(12)[8:12] != b"WAVE":
+        return {}, None, None
+    tags, byte_rate, data_size = {}, 0, 0
+    while True:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            break
+        chunk_id, size = chunk[:4], int.from_bytes(chunk[4:], "little")
+        if chunk_id == b"fmt ":
+            byte_rate = int.from_bytes(f.read(size)[8:12], "little")
+        elif chunk_id == b"data":
+            data_size = min(size, file_size - f.tell())
+            f.seek(size, 1)
+        elif chunk_id == b"LIST":
+            info = f.read(size)
+            pos = 4 if info[:4] == b"INFO" else len(info)
+            while pos + 8 <= len(info):
+                sub_id, sub_size = info[pos:pos + 4], int.from_bytes(info[pos + 4:pos + 8], "little")
+                value = info[pos + 8:pos + 8 + sub_size].split(b"\x00")[0].decode("latin-1").strip()
+                if value and sub_id in (b"INAM", b"IART"):
+                    tags["title" if sub_id == b"INAM" else "artist"] = value
+                pos += 8 + sub_size + (sub_size & 1)
+        else:
+            f.seek(size, 1)
+        if size & 1:
+            f.seek(1, 1)
+    return tags, (data_size / byte_rate if byte_rate else None), "data_size"
 
-@app.before_request
-def ensure_tables():
-    global _db_initialized
-    if not _db_initialized:
-        init_db()
-        _db_initialized = True
+AUDIO_READERS = {".mp3": read_mp3, ".ogg": read_ogg, ".wav": read_wav}
 
+def read_song(path, stat):
+    """Catalog entry for one file: tags win over the "Artist - Title" filename."""
+    artist, title = parse_song_filename(path.name)
+    tags, duration, source = {}, None, None
+    try:
+        with path.open("rb") as f:
+            tags, duration, source = AUDIO_READERS[path.suffix.lower()](f, stat.st_size)
+    except (OSError, ValueError, IndexError, UnicodeError):
+        app.logger.warning("Could not read tags from %s", path.name)
+    return {
+        "filename": path.name,
+        "title": tags.get("title") or title,
+        "artist": tags.get("artist") or artist,
+        "duration": round(duration, 2) if duration else None,
+        "duration_source": source if duration else None,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
 
+class SongCatalog:
+    """Songs in static/jukebox keyed by filename.
+
+    Rebuilt only when the directory's mtime moves (a song added, removed or
+    renamed); files whose size and mtime are unchanged keep their parsed tags.
+    The index is saved to JUKEBOX_CACHE_PATH so a restart does not reopen every
+    file.
+    """
+
+    def __init__(self, directory, cache_path):
+        self.directory = directory
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self._dir_mtime = None
+        self._by_name = {}
+        self._listing = []
+
+    def _refresh(self):
+        try:
+            dir_mtime = self.directory.stat().st_mtime_ns
+        except FileNotFoundError:
+            dir_mtime = None
+        if dir_mtime == self._dir_mtime and self._dir_mtime is not None:
+            return
+        with self._lock:
+            if dir_mtime == self._dir_mtime and self._dir_mtime is not None:
+                return
+            known = self._by_name or self._load_cache()
+            by_name = {}
+            if dir_mtime is not None:
+                for path in self.directory.iterdir():
+                    if path.suffix.lower() not in JUKEBOX_SUFFIXES or not path.is_file():
+                        continue
+                    stat = path.stat()
+                    song = known.get(path.name)
+                    # Entries cached before duration_source existed are read again.
+                    if (not song or song["size"] != stat.st_size or song["mtime_ns"] != stat.st_mtime_ns
+                            or "duration_source" not in song):
+                        song = read_song(path, stat)
+                    by_name[path.name] = song
+            listing = sorted(
+                (song for name, song in by_name.items() if name != THRILLER_FILENAME),
+                key=lambda s: (s["artist"].lower(), s["title"].lower()),
+            )
+            self._by_name, self._listing, self._dir_mtime = by_name, listing, dir_mtime
+            if by_name != known:
+                self._save_cache()
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_cache(self):
+        tmp_path = self.cache_path.with_suffix(".tmp")
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._by_name, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            app.logger.warning("Could not write %s", self.cache_path)
+
+    def get(self, filename):
+        self._refresh()
+        return self._by_name.get(filename)
+
+    def songs(self):
+        """Requestable songs (everything but Thriller), sorted by artist then title."""
+        self._refresh()
+        return self._listing
+
+song_catalog = SongCatalog(JUKEBOX_DIR, JUKEBOX_CACHE_PATH)
+
+# Optional pre-transcoded copies, same filename, for when the Pi's bandwidth is
+# the bottleneck: static/jukebox/low/<filename>.
+JUKEBOX_LOW_DIR = JUKEBOX_DIR / "low"
+JUKEBOX_AUDIO_MAX_AGE = 365 * 24 * 3600
+
+def jukebox_audio_path(song, variant=None):
+    """The file served for a song: its low-bitrate copy when asked for and present."""
+    if variant == "low":
+        low_path = JUKEBOX_LOW_DIR / song["filename"]
+        if low_path.is_file():
+            return low_path
+    return JUKEBOX_DIR / song["filename"]
+
+def jukebox_audio_version(path):
+    return str(path.stat().st_mtime_ns)
+
+def jukebox_audio_url(filename):
+    """Streaming URL for a song; ?v= changes whenever the served file does, so it can be cached for good."""
+    song = song_catalog.get(filename)
+    url = f"/jukebox/audio/{quote(filename)}"
+    if not song:
+        return url
+    path = jukebox_audio_path(song, "low" if JUKEBOX_PREFER_LOW_BITRATE else None)
+    try:
+        url += f"?v={jukebox_audio_version(path)}"
+    except OSError:
+        # Gone since the catalog last looked; the route will 404 it.
+        return url
+    if path.parent == JUKEBOX_LOW_DIR:
+        url += "&variant=low"
+    return url
+
+def serialize_song(song):
+    return {key: song[key] for key in ("filename", "title", "artist", "duration")}
+
+# ---------- Jukebox queue ----------
+JUKEBOX_ACTIVE_SQL = """
+    SELECT q.*, c.name AS requester_name, (julianday(q.started_at) - 2440587.5) * 86400.0 AS started_epoch
+    FROM jukebox_queue q
+    LEFT JOIN characters c ON q.requester_id = c.id
+    WHERE q.status IN ('queued', 'playing')
+    ORDER BY q.id
+"""
+
+JUKEBOX_INSERT_SQL = """
+    INSERT INTO jukebox_queue (id, song_filename, song_title, song_artist, requester_id, status, priority)
+    VALUES (?, ?, ?, ?, ?, 'queued', ?)
+"""
+
+JUKEBOX_START_SQL = """
+    UPDATE jukebox_queue
+    SET status = 'playing', started_at = strftime('%Y-%m-%d %H:%M:%f', ?, 'unixepoch'), priority = ?
+    WHERE id = ?
+"""
+
+JUKEBOX_END_SQL = """
+    UPDATE jukebox_queue
+    SET status = ?, ended_at = CURRENT_TIMESTAMP
+    WHERE id = ? AND status = 'playing'
+"""
+
+JUKEBOX_UP_NEXT_SIZE = 2
+JUKEBOX_CLOCK_TICK_SECONDS = 0.5
+THRILLER_PRIORITY = 999
+
+def jukebox_song(filename):
+    """Catalog entry for filename; Thriller is always playable even if the file is missing."""
+    song = song_catalog.get(filename)
+    if song or filename != THRILLER_FILENAME:
+        return song
+    artist, title = parse_song_filename(filename)
+    return {"filename": filename, "title": title, "artist": artist}
+
+class JukeboxEngine:
+    """The jukebox queue, held in memory and written behind.
+
+    Queued tracks sit in a heap keyed like ORDER BY priority DESC,
+    requested_at ASC, id ASC (ids are handed out here, in request order), so
+    now playing and up next are answered without touching SQLite. Each
+    transition updates memory first and then queues its INSERT or UPDATE with
+    submit_write; the writer runs jobs in submission order, so the table
+    follows the same path a moment later and is only read back on startup.
+
+    The engine also keeps the playback clock. Every track starts at a server
+    timestamp and the catalog knows how long it runs, so a background task
+    announces the next track preload_seconds before the end so the TV can warm
+    its cache. When the length is exact (see EXACT_DURATION_SOURCES, or the TV
+    reported it for a file the catalog could not read) the task also moves on by
+    itself once the TV is more than late_grace_seconds overdue with
+    jukebox_finished; an estimated length never cuts a track short.
+    """
+
+    def __init__(self, up_next_size, preload_seconds, late_grace_seconds, tick_seconds):
+        self.up_next_size = up_next_size
+        self.preload_seconds = preload_seconds
+        self.late_grace_seconds = late_grace_seconds
+        self.tick_seconds = tick_seconds
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._clock_started = False
+        self._announced = None
+        self._playing = None
+        self._heap = []
+        self._queued = {}
+        self._next_id = 1
+        self._now_payload = None
+        self._queue_payload = []
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        conn = get_db()
+        self._playing = None
+        self._heap = []
+        self._queued = {}
+        for row in conn.execute(JUKEBOX_ACTIVE_SQL).fetchall():
+            entry = dict(row)
+            entry["started_at"] = entry.pop("started_epoch")
+            if entry["status"] == "playing":
+                entry["started_at"] = entry["started_at"] or time.time()
+                entry["duration"], entry["duration_exact"] = self._duration(entry)
+                if self._playing is not None:
+                    self._end(self._playing, "skipped")
+                self._playing = entry
+            else:
+                self._push(entry)
+        self._next_id = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM jukebox_queue").fetchone()[0]
+        self._loaded = True
+        if self._playing is None:
+            # Only after a crash between a track ending and the next starting.
+            self._promote()
+        self._refresh()
+        if not self._clock_started:
+            self._clock_started = True
+            socketio.start_background_task(self._run_clock)
+
+    @staticmethod
+    def _key(entry):
+        return (-entry["priority"], entry["id"])
+
+    def _push(self, entry):
+        self._queued[entry["id"]] = entry
+        heapq.heappush(self._heap, (self._key(entry), entry["id"]))
+
+    def _remove(self, entry):
+        del self._queued[entry["id"]]
+        self._heap.remove((self._key(entry), entry["id"]))
+        heapq.heapify(self._heap)
+
+    def _write(self, sql, params):
+        def job(conn):
+            try:
+                conn.execute(sql, params)
+            except sqlite3.Error:
+                app.logger.exception("Jukebox write-behind failed")
+                raise
+        submit_write(job)
+
+    @staticmethod
+    def _duration(entry):
+        """(duration, whether it is exact) from the catalog."""
+        song = song_catalog.get(entry["song_filename"])
+        if not song or not song["duration"]:
+            return None, False
+        return song["duration"], song.get("duration_source") in EXACT_DURATION_SOURCES
+
+    def _start(self, entry, priority=None):
+        if priority is not None:
+            entry["priority"] = priority
+        entry["status"] = "playing"
+        entry["started_at"] = time.time()
+        entry["duration"], entry["duration_exact"] = self._duration(entry)
+        self._playing = entry
+        self._announced = None
+        self._write(JUKEBOX_START_SQL, (entry["started_at"], entry["priority"], entry["id"]))
+
+    def _end(self, entry, status):
+        entry["status"] = status
+        if self._playing is entry:
+            self._playing = None
+        self._write(JUKEBOX_END_SQL, (status, entry["id"]))
+
+    def _promote(self):
+        if self._playing is not None or not self._heap:
+            return
+        _, queue_id = heapq.heappop(self._heap)
+        self._start(self._queued.pop(queue_id))
+
+    def _refresh(self):
+        self._now_payload = serialize_now_playing(self._playing) if self._playing else None
+        self._queue_payload = [
+            serialize_queue_row(self._queued[queue_id])
+            for _, queue_id in heapq.nsmallest(self.up_next_size, self._heap)
+        ]
+        resource_versions.bump("jukebox")
+
+    def _new_entry(self, song, requester_id, priority):
+        requester = roster.get(requester_id)
+        entry = {
+            "id": self._next_id,
+            "song_filename": song["filename"],
+            "song_title": song["title"],
+            "song_artist": song["artist"],
+            "requester_id": requester_id,
+            "requester_name": requester.name if requester else None,
+            "status": "queued",
+            "priority": priority,
+        }
+        self._next_id += 1
+        self._write(JUKEBOX_INSERT_SQL, (
+            entry["id"], entry["song_filename"], entry["song_title"], entry["song_artist"], requester_id, priority,
+        ))
+        return entry
+
+    def _active(self):
+        if self._playing is not None:
+            yield self._playing
+        yield from self._queued.values()
+
+    def now(self):
+        """Serialized now-playing track, or None."""
+        with self._lock:
+            self._ensure_loaded()
+            return self._now_payload
+
+    def up_next(self):
+        with self._lock:
+            self._ensure_loaded()
+            return self._queue_payload
+
+    def active_filenames(self):
+        with self._lock:
+            self._ensure_loaded()
+            return {entry["song_filename"] for entry in self._active()}
+
+    def enqueue(self, song, requester_id, priority=0):
+        """Queue song and start it if nothing is playing; None if it is already queued or playing."""
+        with self._lock:
+            self._ensure_loaded()
+            if any(entry["song_filename"] == song["filename"] for entry in self._active()):
+                return None
+            entry = self._new_entry(song, requester_id, priority)
+            self._push(entry)
+            self._promote()
+            self._refresh()
+            return entry["id"]
+
+    def finish(self, queue_id, status="played"):
+        """End queue_id if it is the track playing and start the next one."""
+        with self._lock:
+            self._ensure_loaded()
+            if self._playing is None or self._playing["id"] != queue_id:
+                return False
+            self._end(self._playing, status)
+            self._promote()
+            self._refresh()
+            return True
+
+    def play_thriller(self, requester_id):
+        """Cut straight to Thriller, reusing a queued copy if there is one."""
+        with self._lock:
+            self._ensure_loaded()
+            current = self._playing
+            if current is not None and current["song_filename"] == THRILLER_FILENAME:
+                target = current
+            else:
+                queued = [entry for entry in self._queued.values() if entry["song_filename"] == THRILLER_FILENAME]
+                if queued:
+                    target = max(queued, key=lambda entry: (entry["priority"], entry["id"]))
+                    self._remove(target)
+                else:
+                    target = self._new_entry(jukebox_song(THRILLER_FILENAME), requester_id, THRILLER_PRIORITY)
+            if current is not target:
+                # Restarting a track that is already playing would move the
+                # clock while the TV carries on from where it is.
+                if current is not None:
+                    self._end(current, "skipped")
+                self._start(target, priority=THRILLER_PRIORITY)
+            self._refresh()
+            return target["id"]
+
+    def tick(self, now):
+        """Run the clock once; returns (jukebox_next payload or None, whether the track changed)."""
+        with self._lock:
+            if not self._loaded or self._playing is None or not self._playing["duration"]:
+                return None, False
+            ends_at = self._playing["started_at"] + self._playing["duration"]
+            if self._playing["duration_exact"] and now >= ends_at + self.late_grace_seconds:
+                self._end(self._playing, "played")
+                self._promote()
+                self._refresh()
+                return None, True
+            if now < ends_at - self.preload_seconds or not self._heap:
+                return None, False
+            # Announce again if the head of the queue changed since the last announcement.
+            head = self._queued[self._heap[0][1]]
+            if self._announced == head["id"]:
+                return None, False
+            self._announced = head["id"]
+            return dict(serialize_now_playing(head), duration=self._duration(head)[0], starts_at=round(ends_at, 3)), False
+
+    def report_duration(self, queue_id, duration):
+        """Take the TV's length for the playing track where the catalog has nothing better."""
+        with self._lock:
+            entry = self._playing
+            if entry is None or entry["id"] != queue_id or entry["duration_exact"]:
+                return False
+            # A length that has already run out would have the clock cut in
+            # ahead of the TV's own jukebox_finished.
+            if entry["started_at"] + duration <= time.time():
+                return False
+            song = song_catalog.get(entry["song_filename"])
+            entry["duration"] = round(duration, 2)
+            # The browser estimates a headerless VBR file from its bitrate too,
+            # so that length only times the preload and never cuts the track.
+            entry["duration_exact"] = not song or song.get("duration_source") != "bitrate"
+            self._refresh()
+            return True
+
+    def _run_clock(self):
+        while True:
+            socketio.sleep(self.tick_seconds)
+            try:
+                announcement, advanced = self.tick(time.time())
+            except Exception:
+                app.logger.exception("Jukebox clock tick failed")
+                continue
+            if announcement:
+                broker.emit("jukebox_next", announcement)
+            if advanced:
+                publish_jukebox()
+
+    def clear(self):
+        """Forget everything; the next read reloads from the (freshly seeded) table."""
+        with self._lock:
+            self._loaded = False
+            self._announced = None
+            self._playing = None
+            self._heap = []
+            self._queued = {}
+            self._now_payload = None
+            self._queue_payload = []
+            resource_versions.bump("jukebox")
+
+jukebox = JukeboxEngine(JUKEBOX_UP_NEXT_SIZE, JUKEBOX_PRELOAD_SECONDS, JUKEBOX_LATE_GRACE_SECONDS, JUKEBOX_CLOCK_TICK_SECONDS)
+
+def serialize_now_playing(entry):
+    return {
+        "queue_id": entry["id"],
+        "filename": entry["song_filename"],
+        "url": jukebox_audio_url(entry["song_filename"]),
+        "title": entry["song_title"],
+        "artist": entry["song_artist"],
+        "requester": entry["requester_name"] or "Unknown",
+        "started_at": round(entry["started_at"], 3) if entry.get("started_at") else None,
+        "duration": entry.get("duration"),
+    }
+
+def serialize_queue_row(entry):
+    return {
+        "queue_id": entry["id"],
+        "title": entry["song_title"],
+        "artist": entry["song_artist"],
+        "requester": entry["requester_name"] or "Unknown",
+    }
+
+def emit_now_playing(now_playing):
+    # server_time lets a client that joins mid-track work out how far in it is.
+    broker.emit("jukebox_now", dict(now_playing, server_time=round(time.time(), 3)))
+
+def publish_jukebox():
+    """Broadcast now playing (or stop) and up next from the engine."""
+    now_playing = jukebox.now()
+    if now_playing:
+        emit_now_playing(now_playing)
+    else:
+        broker.emit("jukebox_stop")
+    broker.emit("jukebox_queue", jukebox.up_next())
+
+# ---------- Search ----------
+SEARCH_PAGE_SIZE = 20
+
+# viewer_id limits results to the public feed plus that character's DMs; the GM
+# passes NULL to search everything.
+SEARCH_SQL = """
+    SELECT m.*, s.name AS sender_name, s.avatar_emoji, r.name AS recipient_name
+    FROM messages_fts f
+    JOIN messages m ON m.id = f.rowid
+    LEFT JOIN characters s ON m.sender_id = s.id
+    LEFT JOIN characters r ON m.recipient_id = r.id
+    WHERE messages_fts MATCH ?
+        AND (? IS NULL OR m.type = 'public' OR ? IN (m.sender_id, m.recipient_id))
+    ORDER BY f.rank, m.id DESC
+    LIMIT ? OFFSET ?
+"""
+
+def build_search_query(text):
+    """Turn free text into an FTS5 query: every word must match, the last as a prefix."""
+    terms = ['"' + term.replace('"', '""') + '"' for term in text.split()[:8]]
+    if not terms:
+        return None
+    terms[-1] += "*"
+    return " ".join(terms)
+
+def serialize_search_result(row, reveal_authors=False):
+    if row["type"] == "public":
+        data = serialize_public_message(row)
+        data["type"] = "public"
+        if reveal_authors and row["is_anonymous"]:
+            data["sender_name"] = row["sender_name"]
+        return data
+    return {
+        "id": row["id"],
+        "type": row["type"],
+        "body": row["body"],
+        "ts": row["ts"],
+        "sender_id": row["sender_id"],
+        "sender_name": row["sender_name"],
+        "recipient_id": row["recipient_id"],
+        "recipient_name": row["recipient_name"],
+    }
+
+def search_messages(text, viewer_id=None, page=1):
+    """Ranked full-text search; viewer_id=None searches every message (GM)."""
+    query = build_search_query(text or "")
+    page = max(page or 1, 1)
+    if not query:
+        return {"query": text or "", "page": page, "has_more": False, "results": []}
+    offset = (page - 1) * SEARCH_PAGE_SIZE
+    rows = get_db().execute(
+        SEARCH_SQL, (query, viewer_id, viewer_id, SEARCH_PAGE_SIZE + 1, offset)
+    ).fetchall()
+    return {
+        "query": text,
+        "page": page,
+        "has_more": len(rows) > SEARCH_PAGE_SIZE,
+        "results": [serialize_search_result(r, reveal_authors=viewer_id is None) for r in rows[:SEARCH_PAGE_SIZE]],
+    }
+
+# ---------- Player app ----------
+def serialize_character(c):
+    return {
+        "id": c["id"],
+        "name": c["name"],
+        "role_tag": c["role_tag"],
+        "avatar_emoji": c["avatar_emoji"],
+        "is_alive": bool(c["is_alive"]),
+        "suspect_score": c["suspect_score"],
+    }
+
+def build_app_bootstrap(character):
+    """Everything the /app shell needs up front; each tab fetches the rest itself."""
+    data = {
+        "character": None,
+        "characters": [serialize_character(c) for c in leaderboard.board_order()],
+        "phase_two": is_phase_two(),
+        "unread": {"dm": 0, "wallet": 0},
+        "cooldown_remaining": 0,
+        "wallet_last_event_id": 0,
+    }
+    if character:
+        data["character"] = {
+            "id": character["id"],
+            "name": character["name"],
+            "avatar_emoji": character["avatar_emoji"],
+            "balance": character["balance"],
+        }
+        data["unread"] = unread_counters.get(character["id"])
+        data["cooldown_remaining"] = rate_limiter.remaining(character["id"], "accuse")
+        data["wallet_last_event_id"] = last_wallet_event_id(character["id"])
+    return data
+
+def wants_json():
+    return request.accept_mimetypes.best == "application/json"
+
+def action_response(error=None, data=None, **view_args):
+    """Finish a player action.
+
+    fetch() callers that accept JSON get {"ok", "error"} plus any data; plain
+    form posts are redirected back to /app with view_args as before.
+    """
+    if wants_json():
+        if error:
+            return jsonify({"ok": False, "error": error}), 400
+        return jsonify({"ok": True, **(data or {})})
+    if error:
+        view_args["error"] = error
+    return redirect(url_for("player_app", **view_args))
+
+def wallet_summary(character_id):
+    return {"balance": roster.get(character_id)["balance"], "unread": unread_counters.get(character_id)}
+
+# ---------- Query plan checks ----------
+# Hot queries and the index each must use. Run `python app.py check-plans` after
+# touching a query or the schema; a full table scan here means every /app
+# reload late in the party walks the whole table again.
+HOT_QUERIES = [
+    ("public feed pinned", PUBLIC_FEED_PINNED_SQL, (), "idx_messages_public_feed"),
+    ("public feed recent", PUBLIC_FEED_RECENT_SQL, (200,), "idx_messages_public_feed"),
+    ("public feed before cursor", PUBLIC_FEED_BEFORE_SQL, (1000, 51), "idx_messages_type_id"),
+    ("dm inbox", DM_INBOX_SQL, (1,), "PRIMARY KEY"),
+    ("dm thread unread count", DM_THREAD_UNREAD_SQL, (1, 2), "PRIMARY KEY"),
+    ("dm thread page", DM_THREAD_PAGE_SQL, (1, 2, 1000, 31), "idx_messages_dm_page"),
+    ("mark thread read", MARK_THREAD_READ_SQL, (1, 2), "idx_messages_dm_unread"),
+    ("message search", SEARCH_SQL, ('"clue"*', 1, 1, 21, 0), "VIRTUAL TABLE INDEX 0:M"),
+    ("wallet pending requests", WALLET_PENDING_SQL, (1,), "idx_wallet_requests_target"),
+    ("recent accusations", RECENT_ACCUSATIONS_SQL, ("-900 seconds",), "idx_accusations_ts"),
+    ("wallet events since", WALLET_EVENTS_SINCE_SQL, (1, 0, WALLET_CATCHUP_LIMIT), "idx_wallet_events_character"),
+    ("wallet notifications", WALLET_NOTIFICATIONS_SQL, (1,), "idx_wallet_notifications_recipient"),
+    ("pending sends", PENDING_SENDS_SQL, (), "idx_wallet_requests_pending_send"),
+    ("pending sends exist", PENDING_SENDS_EXIST_SQL, (), "idx_wallet_requests_pending_send"),
+]
+
+def explain_query_plan(conn, sql, params=()):
+    return [row["detail"] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+
+def query_plan_problems(conn, name, sql, params, index_name):
+    problems = []
+    details = explain_query_plan(conn, sql, params)
+    for detail in details:
+        # "SCAN t USING INDEX" is an ordered index walk and "SCAN t VIRTUAL TABLE
+        # INDEX" an FTS lookup; a bare "SCAN t" reads every row.
+        if detail.startswith("SCAN ") and " USING " not in detail and " VIRTUAL TABLE INDEX " not in detail:
+            problems.append(f"{name}: full table scan ({detail})")
+    if not any(index_name in detail for detail in details):
+        problems.append(f"{name}: expected {index_name}, got {'; '.join(details)}")
+    return problems
+
+def check_query_plans(conn):
+    return [problem for query in HOT_QUERIES for problem in query_plan_problems(conn, *query)]
+
+# ---------- Routes ----------
 @app.route("/")
 def home():
     return redirect(url_for("tv"))
 
 @app.route("/tv")
 def tv():
-    conn = get_db()
-    phase_two = is_phase_two(conn)
-    chars = conn.execute("""
-        SELECT * FROM characters
-        ORDER BY is_alive DESC, suspect_score DESC, id ASC
-    """).fetchall()
-    conn.close()
+    # Marks this browser as the TV, the one client trusted to report track lengths.
+    session["tv"] = True
+    phase_two = is_phase_two()
+    chars = leaderboard.board_order()
     messages = fetch_public_messages()
     return render_template(
         "tv.html",
         characters=chars,
         messages=messages,
+        feed_epoch=get_feed_epoch(),
+        feed_last_id=max((m["id"] for m in messages), default=0),
+        heat=leaderboard.heat_for_window(SUSPECT_HEAT_WINDOW_SECONDS),
         phase_two=phase_two,
         school_name=SCHOOL_NAME,
         school_title=SCHOOL_TITLE,
@@ -647,29 +2695,61 @@ def tv():
 
 @app.route("/api/messages")
 def api_messages():
-    messages = fetch_public_messages()
-    data = [serialize_public_message(m) for m in messages]
-    return jsonify(data)
+    limit = min(max(request.args.get("limit", FEED_PAGE_SIZE, type=int), 1), FEED_PAGE_SIZE)
+    return conditional_json("feed", lambda: feed_page_response(fetch_public_feed_page(
+        since_id=request.args.get("since_id", type=int),
+        before_id=request.args.get("before_id", type=int),
+        limit=limit,
+        epoch=request.args.get("epoch"),
+    )))
 
 @app.route("/api/jukebox/now")
 def api_jukebox_now():
-    conn = get_db()
-    now_playing = ensure_now_playing(conn)
-    conn.close()
-    if not now_playing:
-        return jsonify({})
-    return jsonify(serialize_now_playing(now_playing))
+    response = conditional_json("jukebox", lambda: jukebox.now() or {})
+    # A header rather than a body field, so a 304 still brings the TV's clock up to date.
+    response.headers["X-Server-Time"] = f"{time.time():.3f}"
+    return response
 
 @app.route("/api/jukebox/queue")
 def api_jukebox_queue():
-    conn = get_db()
-    rows = get_up_next(conn, limit=2)
-    conn.close()
-    return jsonify([serialize_queue_row(r) for r in rows])
+    return conditional_json("jukebox", jukebox.up_next)
+
+@app.route("/jukebox/audio/<path:filename>")
+def jukebox_audio(filename):
+    # Only catalogued files are served, which also keeps the path inside JUKEBOX_DIR.
+    song = song_catalog.get(filename)
+    if not song:
+        abort(404)
+    path = jukebox_audio_path(song, request.args.get("variant"))
+    if not path.is_file():
+        abort(404)
+    # Only a URL naming the current version of this exact file may be kept for
+    # good; anything else is revalidated against the ETag every time.
+    current = request.args.get("v") == jukebox_audio_version(path)
+    # conditional=True answers Range, If-Range and If-None-Match from the file
+    # itself; the file object goes to the server's wsgi.file_wrapper, which
+    # sends it without copying through Python where the server supports it.
+    response = send_file(path, conditional=True, etag=True, max_age=JUKEBOX_AUDIO_MAX_AGE if current else None)
+    if current:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
 
 @app.route("/api/photobooth/strips")
 def api_photobooth_strips():
-    return jsonify(get_photostrips())
+    return conditional_json("photostrips", get_photostrips)
+
+@app.route("/api/leaderboard")
+def api_leaderboard():
+    window = request.args.get("window", SUSPECT_HEAT_WINDOW_SECONDS, type=int)
+    window = min(max(window, 60), 24 * 3600)
+    entries = leaderboard.snapshot()
+    if window != SUSPECT_HEAT_WINDOW_SECONDS:
+        heat = leaderboard.heat_for_window(window)
+        for entry in entries:
+            entry["heat"] = heat.get(entry["character_id"], 0)
+    return jsonify({"window_seconds": window, "entries": entries})
 
 @app.route("/api/photobooth/upload", methods=["POST"])
 def api_photobooth_upload():
@@ -681,33 +2761,36 @@ def api_photobooth_upload():
         strip = save_photostrip(images)
     except Exception:
         return jsonify({"error": "Failed to save images"}), 400
-    socketio.emit("photobooth_new", strip)
+    broker.emit("photobooth_new", strip)
     return jsonify(strip)
 
+@app.route("/api/search")
+def api_search():
+    character = get_logged_in_character()
+    if not character:
+        abort(401)
+    return jsonify(search_messages(
+        request.args.get("q"),
+        viewer_id=character["id"],
+        page=request.args.get("page", 1, type=int),
+    ))
+
 @app.route("/api/thread/<int:other_id>")
 def api_thread(other_id):
-    character = get_logged_in_character()
+    character = current_identity()
     if not character:
         abort(401)
     if other_id == character["id"]:
         abort(400)
-    mark_thread_read(character["id"], other_id)
-    rows = fetch_thread_messages(character["id"], other_id)
-    data = []
-    for r in rows:
-        data.append({
-            "id": r["id"],
-            "body": r["body"],
-            "ts": r["ts"],
-            "sender_id": r["sender_id"],
-            "sender_name": r["sender_name"],
-            "sender_avatar": r["sender_avatar"],
-        })
-    return jsonify(data)
+    before_id = request.args.get("before_id", type=int)
+    if before_id is None:
+        mark_thread_read(character["id"], other_id)
+    messages, has_more = fetch_thread_messages(character["id"], other_id, before_id=before_id)
+    return jsonify({"messages": messages, "has_more": has_more})
 
 @app.route("/api/thread/<int:other_id>/read", methods=["POST"])
 def api_thread_read(other_id):
-    character = get_logged_in_character()
+    character = current_identity()
     if not character:
         abort(401)
     if other_id == character["id"]:
@@ -718,115 +2801,77 @@ def api_thread_read(other_id):
 @app.route("/app")
 def player_app():
     character = get_logged_in_character()
-    conn = get_db()
-    phase_two = is_phase_two(conn)
-    characters = conn.execute("""
-        SELECT * FROM characters
-        ORDER BY is_alive DESC, suspect_score DESC, id ASC
-    """).fetchall()
-    queued_files = {
-        row["song_filename"]
-        for row in conn.execute("""
-            SELECT song_filename FROM jukebox_queue
-            WHERE status IN ('queued', 'playing')
-        """).fetchall()
-    }
-    dm_threads = []
-    wallet_pending = []
-    wallet_notifications = []
-    wallet_pending_count = 0
-    if character:
-        dm_threads = build_dm_threads(conn, character["id"], characters)
-        settle_pending_sends(conn, character["id"])
-        conn.commit()
-        wallet_pending = conn.execute("""
-            SELECT r.*, c.name AS requester_name, c.avatar_emoji AS requester_avatar
-            FROM wallet_requests r
-            JOIN characters c ON r.requester_id = c.id
-            WHERE r.target_id = ? AND r.status = 'pending' AND r.request_type = 'request'
-            ORDER BY r.created_at DESC
-        """, (character["id"],)).fetchall()
-        wallet_notifications = conn.execute("""
-            SELECT n.*, c.name AS sender_name, c.avatar_emoji AS sender_avatar
-            FROM wallet_notifications n
-            JOIN characters c ON n.sender_id = c.id
-            WHERE n.recipient_id = ? AND n.status = 'unread'
-            ORDER BY n.created_at DESC
-        """, (character["id"],)).fetchall()
-        wallet_pending_count = len(wallet_pending) + len(wallet_notifications)
-    conn.close()
-    public_messages = fetch_public_messages()
-    songs = get_song_catalog()
-    for s in songs:
-        s["queued"] = s["filename"] in queued_files
-    selected_dm = request.args.get("dm", type=int)
-    error = request.args.get("error")
-    tab = request.args.get("tab") or "feed"
-    cooldown_remaining = 0
-    if character:
-        now = time.time()
-        last_session = session.get("last_accuse_ts", 0)
-        last_memory = last_accuse_times.get(character["id"], 0)
-        last = max(last_session, last_memory)
-        if last > last_session:
-            session["last_accuse_ts"] = last
-        remaining = ACCUSE_COOLDOWN_SECONDS - (now - last)
-        cooldown_remaining = int(remaining) if remaining > 0 else 0
-
-    if character and selected_dm is None:
-        if dm_threads:
-            selected_dm = dm_threads[0]["other_id"]
-        else:
-            for c in characters:
-                if c["id"] != character["id"]:
-                    selected_dm = c["id"]
-                    break
-
-    thread_messages = []
-    if character and selected_dm and tab == "dm":
-        mark_thread_read(character["id"], selected_dm)
-        thread_messages = fetch_thread_messages(character["id"], selected_dm)
-        for thread in dm_threads:
-            if thread["other_id"] == selected_dm:
-                thread["unread_count"] = 0
-                break
-    dm_unread_total = sum(t["unread_count"] for t in dm_threads) if character else 0
-
-    selected_dm_name = None
-    selected_dm_role = None
-    selected_dm_avatar = None
-    if character and selected_dm:
-        for c in characters:
-            if c["id"] == selected_dm:
-                selected_dm_name = c["name"]
-                selected_dm_role = c["role_tag"]
-                selected_dm_avatar = c["avatar_emoji"]
-                break
-
+    bootstrap = build_app_bootstrap(character)
     return render_template(
         "app.html",
         character=character,
-        characters=characters,
-        messages=public_messages,
-        error=error,
-        selected_dm=selected_dm,
-        thread_messages=thread_messages,
-        tab=tab,
-        dm_threads=dm_threads,
-        dm_unread_total=dm_unread_total,
-        selected_dm_name=selected_dm_name,
-        selected_dm_role=selected_dm_role,
-        selected_dm_avatar=selected_dm_avatar,
-        cooldown_remaining=cooldown_remaining,
-        songs=songs,
-        wallet_pending=wallet_pending,
-        wallet_notifications=wallet_notifications,
-        wallet_pending_count=wallet_pending_count,
-        phase_two=phase_two,
+        characters=leaderboard.board_order(),
+        bootstrap=bootstrap,
+        error=request.args.get("error"),
+        selected_dm=request.args.get("dm", type=int),
+        tab=request.args.get("tab") or "feed",
+        dm_unread_total=bootstrap["unread"]["dm"],
+        wallet_pending_count=bootstrap["unread"]["wallet"],
+        cooldown_remaining=bootstrap["cooldown_remaining"],
+        phase_two=bootstrap["phase_two"],
         school_name=SCHOOL_NAME,
         school_title=SCHOOL_TITLE,
     )
 
+@app.route("/api/app/bootstrap")
+def api_app_bootstrap():
+    return jsonify(build_app_bootstrap(get_logged_in_character()))
+
+@app.route("/api/app/dm")
+def api_app_dm():
+    character = get_logged_in_character()
+    if not character:
+        abort(401)
+    return jsonify({"threads": build_dm_threads(get_db(), character["id"], leaderboard.board_order())})
+
+@app.route("/api/app/suspect")
+def api_app_suspect():
+    character = get_logged_in_character()
+    if not character:
+        abort(401)
+    return jsonify({
+        "characters": [serialize_character(c) for c in leaderboard.board_order() if c["id"] != character["id"]],
+        "cooldown_remaining": rate_limiter.remaining(character["id"], "accuse"),
+    })
+
+@app.route("/api/app/jukebox")
+def api_app_jukebox():
+    queued_files = jukebox.active_filenames()
+    songs = [
+        dict(serialize_song(song), queued=song["filename"] in queued_files)
+        for song in song_catalog.songs()
+    ]
+    return jsonify({"songs": songs})
+
+@app.route("/api/app/wallet")
+def api_app_wallet():
+    character = get_logged_in_character()
+    if not character:
+        abort(401)
+    conn = get_db()
+    pending = conn.execute(WALLET_PENDING_SQL, (character["id"],)).fetchall()
+    notifications = conn.execute(WALLET_NOTIFICATIONS_SQL, (character["id"],)).fetchall()
+    return jsonify({
+        "balance": roster.get(character["id"])["balance"],
+        "pending": [{
+            "id": r["id"],
+            "amount": r["amount"],
+            "requester_name": r["requester_name"],
+            "requester_avatar": r["requester_avatar"],
+        } for r in pending],
+        "notifications": [{
+            "id": n["id"],
+            "amount": n["amount"],
+            "sender_name": n["sender_name"],
+            "sender_avatar": n["sender_avatar"],
+        } for n in notifications],
+    })
+
 @app.route("/photobooth")
 def photobooth():
     return render_template("photobooth.html")
@@ -837,223 +2882,218 @@ def app_login():
     if not code:
         return redirect(url_for("player_app", error="Enter your code."))
 
-    conn = get_db()
-    char = conn.execute("SELECT * FROM characters WHERE UPPER(login_code) = ?", (code,)).fetchone()
-    conn.close()
+    char = roster.find_by_login_code(code)
 
     if not char:
         return redirect(url_for("player_app", error="Code not found. Check with the GM."))
 
-    session["character_id"] = char["id"]
+    remember_identity(char)
     return redirect(url_for("player_app"))
 
 @app.route("/app/logout")
 def app_logout():
-    session.pop("character_id", None)
+    forget_identity()
     return redirect(url_for("player_app"))
 
 @app.route("/app/post", methods=["POST"])
 def app_post():
     character = get_logged_in_character()
     if not character:
-        return redirect(url_for("player_app", error="Log in first."))
+        return action_response("Log in first.")
 
     content = (request.form.get("content") or "").strip()
     is_anonymous = 1 if request.form.get("anonymous") == "on" else 0
 
     if not content:
-        return redirect(url_for("player_app", error="Message cannot be empty."))
+        return action_response("Message cannot be empty.")
     if len(content) > 280:
         content = content[:280]
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO messages (type, sender_id, recipient_id, body, is_anonymous, is_read)
-        VALUES ('public', ?, NULL, ?, ?, 1)
-    """, (character["id"], content, is_anonymous))
-    new_id = cur.lastrowid
-    conn.commit()
-    row = conn.execute("""
-        SELECT m.*, c.name AS sender_name, c.avatar_emoji
-        FROM messages m
-        LEFT JOIN characters c ON m.sender_id = c.id
-        WHERE m.id = ?
-    """, (new_id,)).fetchone()
-    conn.close()
+    def post(conn):
+        error = rate_limit_error(conn, character["id"], "post")
+        if error:
+            return None, error
+        new_id = conn.execute("""
+            INSERT INTO messages (type, sender_id, recipient_id, body, is_anonymous, is_read)
+            VALUES ('public', ?, NULL, ?, ?, 1)
+        """, (character["id"], content, is_anonymous)).lastrowid
+        return publish_public_message(conn, new_id), None
 
-    payload = serialize_public_message(row)
-    socketio.emit("public_message", payload)
+    entry, error = db_write(post)
+    if error:
+        return action_response(error)
+    broker.emit("public_message", entry.payload)
 
-    return redirect(url_for("player_app"))
+    return action_response(data={"message": entry.payload})
 
 @app.route("/app/jukebox/queue", methods=["POST"])
 def app_jukebox_queue():
     character = get_logged_in_character()
     if not character:
-        return redirect(url_for("player_app", error="Log in to queue songs.", tab="jukebox"))
+        return action_response("Log in to queue songs.", tab="jukebox")
 
     filename = (request.form.get("song_filename") or "").strip()
     if not filename:
-        return redirect(url_for("player_app", error="Pick a song to queue.", tab="jukebox"))
+        return action_response("Pick a song to queue.", tab="jukebox")
 
-    songs = get_song_catalog()
-    selected = next((s for s in songs if s["filename"] == filename), None)
-    if not selected:
-        return redirect(url_for("player_app", error="Song not found.", tab="jukebox"))
+    selected = song_catalog.get(filename)
+    if not selected or filename == THRILLER_FILENAME:
+        return action_response("Song not found.", tab="jukebox")
 
-    conn = get_db()
-    exists = conn.execute("""
-        SELECT 1 FROM jukebox_queue
-        WHERE song_filename = ? AND status IN ('queued', 'playing')
-        LIMIT 1
-    """, (filename,)).fetchone()
-    if exists:
-        conn.close()
-        return redirect(url_for("player_app", error="That song is already queued or playing.", tab="jukebox"))
-    current = get_current_playing(conn)
-    conn.execute("""
-        INSERT INTO jukebox_queue (song_filename, song_title, song_artist, requester_id, status)
-        VALUES (?, ?, ?, ?, 'queued')
-    """, (selected["filename"], selected["title"], selected["artist"], character["id"]))
-    conn.commit()
-    now_playing = None
-    if not current:
-        now_playing = ensure_now_playing(conn)
-    queue_rows = get_up_next(conn, limit=2)
-    conn.close()
+    queue_id = jukebox.enqueue(selected, character["id"])
+    if queue_id is None:
+        return action_response("That song is already queued or playing.", tab="jukebox")
 
-    if now_playing:
-        socketio.emit("jukebox_now", serialize_now_playing(now_playing))
-    socketio.emit("jukebox_queue", [serialize_queue_row(r) for r in queue_rows])
-    return redirect(url_for("player_app", tab="jukebox"))
+    # Only a song that started straight away changes what the TV is playing.
+    now_playing = jukebox.now()
+    if now_playing and now_playing["queue_id"] == queue_id:
+        emit_now_playing(now_playing)
+    broker.emit("jukebox_queue", jukebox.up_next())
+    return action_response(tab="jukebox")
 
 @app.route("/app/wallet/send", methods=["POST"])
 def app_wallet_send():
     character = get_logged_in_character()
     if not character:
-        return redirect(url_for("player_app", error="Log in to send money.", tab="wallet"))
+        return action_response("Log in to send money.", tab="wallet")
 
     target_id = request.form.get("target_id", type=int)
     amount = parse_amount(request.form.get("amount"))
 
     if not target_id:
-        return redirect(url_for("player_app", error="Pick someone to send money to.", tab="wallet"))
+        return action_response("Pick someone to send money to.", tab="wallet")
     if target_id == character["id"]:
-        return redirect(url_for("player_app", error="You cannot send money to yourself.", tab="wallet"))
+        return action_response("You cannot send money to yourself.", tab="wallet")
     if not amount:
-        return redirect(url_for("player_app", error="Enter a valid amount.", tab="wallet"))
-
-    conn = get_db()
-    target = conn.execute("SELECT id FROM characters WHERE id = ?", (target_id,)).fetchone()
-    if not target:
-        conn.close()
-        return redirect(url_for("player_app", error="Recipient not found.", tab="wallet"))
+        return action_response("Enter a valid amount.", tab="wallet")
+
+    def send_money(conn):
+        target = conn.execute("SELECT id FROM characters WHERE id = ?", (target_id,)).fetchone()
+        if not target:
+            return "Recipient not found."
+        if not has_balance(conn, character["id"], amount):
+            return "Not enough balance for that transfer."
+        error = rate_limit_error(conn, character["id"], "wallet")
+        if error:
+            return error
+        if not ledger_transfer(conn, character["id"], target_id, amount, "send"):
+            return "Not enough balance for that transfer."
+        conn.execute("""
+            INSERT INTO wallet_notifications (sender_id, recipient_id, amount, status)
+            VALUES (?, ?, ?, 'unread')
+        """, (character["id"], target_id, amount))
+        bump_unread(target_id, "wallet", 1)
+        return None
 
-    balance = conn.execute("SELECT balance FROM characters WHERE id = ?", (character["id"],)).fetchone()["balance"]
-    if amount > balance:
-        conn.close()
-        return redirect(url_for("player_app", error="Not enough balance for that transfer.", tab="wallet"))
-
-    conn.execute("UPDATE characters SET balance = balance - ? WHERE id = ?", (amount, character["id"]))
-    conn.execute("UPDATE characters SET balance = balance + ? WHERE id = ?", (amount, target_id))
-    conn.execute("""
-        INSERT INTO wallet_notifications (sender_id, recipient_id, amount, status)
-        VALUES (?, ?, ?, 'unread')
-    """, (character["id"], target_id, amount))
-    conn.commit()
-    conn.close()
-    return redirect(url_for("player_app", tab="wallet"))
+    error = db_write(send_money)
+    if error:
+        return action_response(error, tab="wallet")
+    return action_response(data=wallet_summary(character["id"]), tab="wallet")
 
 @app.route("/app/wallet/request", methods=["POST"])
 def app_wallet_request():
     character = get_logged_in_character()
     if not character:
-        return redirect(url_for("player_app", error="Log in to request money.", tab="wallet"))
+        return action_response("Log in to request money.", tab="wallet")
 
     target_id = request.form.get("target_id", type=int)
     amount = parse_amount(request.form.get("amount"))
 
     if not target_id:
-        return redirect(url_for("player_app", error="Pick someone to request money from.", tab="wallet"))
+        return action_response("Pick someone to request money from.", tab="wallet")
     if target_id == character["id"]:
-        return redirect(url_for("player_app", error="You cannot request money from yourself.", tab="wallet"))
+        return action_response("You cannot request money from yourself.", tab="wallet")
     if not amount:
-        return redirect(url_for("player_app", error="Enter a valid amount.", tab="wallet"))
+        return action_response("Enter a valid amount.", tab="wallet")
+
+    if not roster.get(target_id):
+        return action_response("Recipient not found.", tab="wallet")
+
+    def create_request(wconn):
+        error = rate_limit_error(wconn, character["id"], "wallet")
+        if error:
+            return error
+        wconn.execute("""
+            INSERT INTO wallet_requests (requester_id, target_id, amount, request_type, status)
+            VALUES (?, ?, ?, 'request', 'pending')
+        """, (character["id"], target_id, amount))
+        request_id = wconn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        record_wallet_event(wconn, target_id, "request", character["id"], amount, request_id)
+        bump_unread(target_id, "wallet", 1)
+        return None
 
-    conn = get_db()
-    target = conn.execute("SELECT id FROM characters WHERE id = ?", (target_id,)).fetchone()
-    if not target:
-        conn.close()
-        return redirect(url_for("player_app", error="Recipient not found.", tab="wallet"))
-
-    conn.execute("""
-        INSERT INTO wallet_requests (requester_id, target_id, amount, request_type, status)
-        VALUES (?, ?, ?, 'request', 'pending')
-    """, (character["id"], target_id, amount))
-    conn.commit()
-    conn.close()
-    return redirect(url_for("player_app", tab="wallet"))
+    error = db_write(create_request)
+    if error:
+        return action_response(error, tab="wallet")
+    return action_response(data=wallet_summary(character["id"]), tab="wallet")
 
 @app.route("/app/wallet/request/respond", methods=["POST"])
 def app_wallet_request_respond():
     character = get_logged_in_character()
     if not character:
-        return redirect(url_for("player_app", error="Log in to respond.", tab="wallet"))
+        return action_response("Log in to respond.", tab="wallet")
 
     request_id = request.form.get("request_id", type=int)
     decision = (request.form.get("decision") or "").strip().lower()
     if not request_id or decision not in {"accept", "decline"}:
-        return redirect(url_for("player_app", error="Invalid request response.", tab="wallet"))
+        return action_response("Invalid request response.", tab="wallet")
+
+    def respond(conn):
+        row = conn.execute("""
+            SELECT * FROM wallet_requests
+            WHERE id = ? AND target_id = ?
+        """, (request_id, character["id"])).fetchone()
+        if not row or row["status"] != "pending":
+            return "That request is no longer pending."
+
+        if decision == "decline":
+            error = rate_limit_error(conn, character["id"], "wallet")
+            if error:
+                return error
+            conn.execute("""
+                UPDATE wallet_requests
+                SET status = 'declined', responded_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            """, (request_id,))
+            record_wallet_event(conn, row["requester_id"], "declined", character["id"], row["amount"], request_id)
+            if row["request_type"] == "request":
+                bump_unread(character["id"], "wallet", -1)
+            return None
 
-    conn = get_db()
-    row = conn.execute("""
-        SELECT * FROM wallet_requests
-        WHERE id = ? AND target_id = ?
-    """, (request_id, character["id"])).fetchone()
-    if not row or row["status"] != "pending":
-        conn.close()
-        return redirect(url_for("player_app", error="That request is no longer pending.", tab="wallet"))
-
-    if decision == "decline":
+        amount = row["amount"]
+        if amount <= 0:
+            return "Invalid request amount."
+        if not has_balance(conn, character["id"], amount):
+            return "Not enough balance to send that amount."
+        error = rate_limit_error(conn, character["id"], "wallet")
+        if error:
+            return error
+
+        if not ledger_transfer(conn, character["id"], row["requester_id"], amount, row["request_type"], request_id):
+            return "Not enough balance to send that amount."
         conn.execute("""
             UPDATE wallet_requests
-            SET status = 'declined', responded_at = CURRENT_TIMESTAMP
+            SET status = 'accepted', responded_at = CURRENT_TIMESTAMP
             WHERE id = ?
         """, (request_id,))
-        conn.commit()
-        conn.close()
-        return redirect(url_for("player_app", tab="wallet"))
-
-    amount = row["amount"]
-    if amount <= 0:
-        conn.close()
-        return redirect(url_for("player_app", error="Invalid request amount.", tab="wallet"))
-
-    balance = conn.execute("SELECT balance FROM characters WHERE id = ?", (character["id"],)).fetchone()["balance"]
-    if amount > balance:
-        conn.close()
-        return redirect(url_for("player_app", error="Not enough balance to send that amount.", tab="wallet"))
-    conn.execute("UPDATE characters SET balance = balance - ? WHERE id = ?", (amount, character["id"]))
-    conn.execute("UPDATE characters SET balance = balance + ? WHERE id = ?", (amount, row["requester_id"]))
-    conn.execute("""
-        UPDATE wallet_requests
-        SET status = 'accepted', responded_at = CURRENT_TIMESTAMP
-        WHERE id = ?
-    """, (request_id,))
-    conn.commit()
-    conn.close()
-    return redirect(url_for("player_app", tab="wallet"))
+        if row["request_type"] == "request":
+            bump_unread(character["id"], "wallet", -1)
+        return None
+
+    error = db_write(respond)
+    if error:
+        return action_response(error, tab="wallet")
+    return action_response(data=wallet_summary(character["id"]), tab="wallet")
 
 @app.route("/app/wallet/notification/dismiss", methods=["POST"])
 def app_wallet_notification_dismiss():
     character = get_logged_in_character()
     if not character:
-        return redirect(url_for("player_app", error="Log in to manage notifications.", tab="wallet"))
+        return action_response("Log in to manage notifications.", tab="wallet")
 
     notification_id = request.form.get("notification_id", type=int)
     if not notification_id:
-        return redirect(url_for("player_app", error="Notification not found.", tab="wallet"))
+        return action_response("Notification not found.", tab="wallet")
 
     conn = get_db()
     row = conn.execute("""
@@ -1061,55 +3101,49 @@ def app_wallet_notification_dismiss():
         WHERE id = ? AND recipient_id = ?
     """, (notification_id, character["id"])).fetchone()
     if not row:
-        conn.close()
-        return redirect(url_for("player_app", error="Notification not found.", tab="wallet"))
+        return action_response("Notification not found.", tab="wallet")
 
-    conn.execute("""
-        UPDATE wallet_notifications
-        SET status = 'read'
-        WHERE id = ?
-    """, (notification_id,))
-    conn.commit()
-    conn.close()
-    return redirect(url_for("player_app", tab="wallet"))
+    def dismiss(wconn):
+        updated = wconn.execute("""
+            UPDATE wallet_notifications
+            SET status = 'read'
+            WHERE id = ? AND status = 'unread'
+        """, (notification_id,)).rowcount
+        bump_unread(character["id"], "wallet", -updated)
+
+    db_write(dismiss)
+    return action_response(data=wallet_summary(character["id"]), tab="wallet")
 
 @app.route("/app/dm", methods=["POST"])
 def app_dm():
     character = get_logged_in_character()
     if not character:
-        return redirect(url_for("player_app", error="Log in first."))
+        return action_response("Log in first.")
 
     recipient_id = request.form.get("recipient_id", type=int)
     body = (request.form.get("body") or "").strip()
 
     if not recipient_id:
-        return redirect(url_for("player_app", error="Choose someone to DM.", tab="dm"))
+        return action_response("Choose someone to DM.", tab="dm")
     if recipient_id == character["id"]:
-        return redirect(url_for("player_app", error="You cannot DM yourself.", dm=recipient_id, tab="dm"))
+        return action_response("You cannot DM yourself.", dm=recipient_id, tab="dm")
     if not body:
-        return redirect(url_for("player_app", error="Message cannot be empty.", dm=recipient_id, tab="dm"))
+        return action_response("Message cannot be empty.", dm=recipient_id, tab="dm")
     if len(body) > 280:
         body = body[:280]
 
-    conn = get_db()
-    target = conn.execute("SELECT id FROM characters WHERE id = ?", (recipient_id,)).fetchone()
-    if not target:
-        conn.close()
-        return redirect(url_for("player_app", error="Recipient not found.", tab="dm"))
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO messages (type, sender_id, recipient_id, body, is_anonymous, is_read)
-        VALUES ('dm', ?, ?, ?, 0, 0)
-    """, (character["id"], recipient_id, body))
-    new_id = cur.lastrowid
-    conn.commit()
-    row = conn.execute("""
-        SELECT m.*, s.name AS sender_name, s.avatar_emoji AS sender_avatar
-        FROM messages m
-        LEFT JOIN characters s ON m.sender_id = s.id
-        WHERE m.id = ?
-    """, (new_id,)).fetchone()
-    conn.close()
+    if not roster.get(recipient_id):
+        return action_response("Recipient not found.", tab="dm")
+
+    def send_dm(wconn):
+        error = rate_limit_error(wconn, character["id"], "dm")
+        if error:
+            return None, error
+        return record_dm(wconn, character["id"], recipient_id, body), None
+
+    row, error = db_write(send_dm)
+    if error:
+        return action_response(error, dm=recipient_id, tab="dm")
 
     payload = {
         "id": row["id"],
@@ -1122,146 +3156,135 @@ def app_dm():
     }
     room_sender = f"char-{character['id']}"
     room_recipient = f"char-{recipient_id}"
-    socketio.emit("dm", payload, room=room_sender)
+    broker.emit("dm", payload, room=room_sender)
     if room_recipient != room_sender:
-        socketio.emit("dm", payload, room=room_recipient)
+        broker.emit("dm", payload, room=room_recipient)
 
-    return redirect(url_for("player_app", dm=recipient_id, tab="dm"))
+    return action_response(data={"message": payload}, dm=recipient_id, tab="dm")
 
 @app.route("/app/accuse", methods=["POST"])
 def app_accuse():
     character = get_logged_in_character()
     if not character:
-        return redirect(url_for("player_app", error="Log in first."))
+        return action_response("Log in first.")
 
     if not is_phase_two():
-        return redirect(url_for("player_app", error="Suspecting unlocks after the first murder.", tab="feed"))
+        return action_response("Suspecting unlocks after the first murder.", tab="feed")
 
     accused_id = request.form.get("accused_id", type=int)
     if not accused_id:
-        return redirect(url_for("player_app", error="Pick someone to accuse.", tab="suspect"))
+        return action_response("Pick someone to accuse.", tab="suspect")
     if accused_id == character["id"]:
-        return redirect(url_for("player_app", error="You cannot accuse yourself.", tab="suspect"))
-
-    now = time.time()
-    last_session = session.get("last_accuse_ts", 0)
-    last_memory = last_accuse_times.get(character["id"], 0)
-    last = max(last_session, last_memory)
-    if now - last < ACCUSE_COOLDOWN_SECONDS:
-        remaining = int(ACCUSE_COOLDOWN_SECONDS - (now - last))
-        session["last_accuse_ts"] = last
-        return redirect(url_for("player_app", error=f"Wait {remaining//60}:{remaining%60:02d} before accusing again.", tab="suspect"))
-    last_accuse_times[character["id"]] = now
-    session["last_accuse_ts"] = now
+        return action_response("You cannot accuse yourself.", tab="suspect")
 
-    conn = get_db()
-    target = conn.execute("SELECT id, is_alive FROM characters WHERE id = ?", (accused_id,)).fetchone()
+    target = roster.get(accused_id)
     if not target:
-        conn.close()
-        return redirect(url_for("player_app", error="That character doesn't exist.", tab="suspect"))
+        return action_response("That character doesn't exist.", tab="suspect")
     if not target["is_alive"]:
-        conn.close()
-        return redirect(url_for("player_app", error="You cannot accuse someone who's already dead.", tab="suspect"))
-    cur = conn.cursor()
-    cur.execute("INSERT INTO accusations (accuser_id, accused_id, points) VALUES (?, ?, 1)", (character["id"], accused_id))
-    cur.execute("UPDATE characters SET suspect_score = suspect_score + 1 WHERE id = ?", (accused_id,))
-    new_score = conn.execute("SELECT suspect_score FROM characters WHERE id = ?", (accused_id,)).fetchone()["suspect_score"]
-    conn.commit()
-    conn.close()
+        return action_response("You cannot accuse someone who's already dead.", tab="suspect")
 
-    socketio.emit("suspect_update", {"character_id": accused_id, "suspect_score": new_score})
-    return redirect(url_for("player_app", tab="suspect"))
+    def accuse(wconn):
+        if not rate_limiter.take(wconn, character["id"], "accuse"):
+            return None
+        accusation_id = wconn.execute("INSERT INTO accusations (accuser_id, accused_id, points) VALUES (?, ?, 1)", (character["id"], accused_id)).lastrowid
+        wconn.execute("UPDATE characters SET suspect_score = suspect_score + 1 WHERE id = ?", (accused_id,))
+        score = wconn.execute("SELECT suspect_score FROM characters WHERE id = ?", (accused_id,)).fetchone()["suspect_score"]
+        on_commit(lambda: roster.set_score(accused_id, score))
+        on_commit(lambda: publish_leaderboard([accused_id], accused_id, 1, accusation_id))
+        return score
+
+    new_score = db_write(accuse)
+    if new_score is None:
+        remaining = rate_limiter.remaining(character["id"], "accuse")
+        return action_response(f"Wait {remaining//60}:{remaining%60:02d} before accusing again.", tab="suspect")
+
+    broker.emit("suspect_update", {"character_id": accused_id, "suspect_score": new_score})
+    return action_response(data={
+        "character_id": accused_id,
+        "suspect_score": new_score,
+        "cooldown_remaining": rate_limiter.remaining(character["id"], "accuse"),
+    }, tab="suspect")
 
 @app.route("/gm")
 def gm():
-    conn = get_db()
-    characters = conn.execute("""
-        SELECT * FROM characters
-        ORDER BY is_alive DESC, name ASC
-    """).fetchall()
-    phase_two = is_phase_two(conn)
-    conn.close()
+    characters = roster.gm_order()
+    phase_two = is_phase_two()
     return render_template("gm.html", characters=characters, phase_two=phase_two)
 
+@app.route("/gm/search")
+def gm_search():
+    return jsonify(search_messages(request.args.get("q"), page=request.args.get("page", 1, type=int)))
+
 @app.route("/gm/kill", methods=["POST"])
 def gm_kill():
     target_id = request.form.get("character_id", type=int)
     action = (request.form.get("action") or "kill").strip().lower()
     if not target_id:
         return redirect(url_for("gm"))
-    conn = get_db()
-    before_phase = is_phase_two(conn)
-    row = conn.execute("SELECT id, is_alive, suspect_score, name FROM characters WHERE id = ?", (target_id,)).fetchone()
-    if not row:
-        conn.close()
-        return redirect(url_for("gm"))
+    def kill_or_revive(conn):
+        before_phase = count_dead(conn) > 0
+        row = conn.execute("SELECT id, is_alive, suspect_score, name FROM characters WHERE id = ?", (target_id,)).fetchone()
+        if not row:
+            return None
 
-    if action == "revive":
-        conn.execute("UPDATE characters SET is_alive = 1 WHERE id = ?", (target_id,))
-    else:
-        conn.execute("UPDATE characters SET is_alive = 0, suspect_score = 0 WHERE id = ?", (target_id,))
-    conn.commit()
-    after_phase = is_phase_two(conn)
-    updated = conn.execute("SELECT id, suspect_score, is_alive FROM characters WHERE id = ?", (target_id,)).fetchone()
-    conn.close()
+        if action == "revive":
+            conn.execute("UPDATE characters SET is_alive = 1 WHERE id = ?", (target_id,))
+            on_commit(lambda: roster.set_alive(target_id, True))
+        else:
+            conn.execute("UPDATE characters SET is_alive = 0, suspect_score = 0 WHERE id = ?", (target_id,))
+            on_commit(lambda: roster.set_alive(target_id, False, suspect_score=0))
+        on_commit(lambda: publish_leaderboard([target_id]))
+        after_phase = count_dead(conn) > 0
+
+        murder_msg = None
+        if action != "revive" and after_phase:
+            murder_msg_id = conn.execute("""
+                INSERT INTO messages (type, sender_id, recipient_id, body, is_anonymous, is_read, pinned)
+                VALUES ('public', NULL, NULL, ?, 0, 1, 1)
+            """, (f"{row['name']} has been murdered. Anyone could be a suspect now. Report suspicious behavior by accusing someone under 'Suspect' in your app.",)).lastrowid
+            murder_msg = publish_public_message(conn, murder_msg_id)
+
+        trigger_thriller = action != "revive" and after_phase and not before_phase
+        return before_phase, after_phase, murder_msg, trigger_thriller
+
+    outcome = db_write(kill_or_revive)
+    if outcome is None:
+        return redirect(url_for("gm"))
+    before_phase, after_phase, murder_msg, trigger_thriller = outcome
+    updated = roster.get(target_id)
 
-    socketio.emit("character_status", {
+    broker.emit("character_status", {
         "character_id": updated["id"],
         "is_alive": bool(updated["is_alive"]),
         "suspect_score": updated["suspect_score"],
     })
-    socketio.emit("suspect_update", {"character_id": updated["id"], "suspect_score": updated["suspect_score"]})
+    broker.emit("suspect_update", {"character_id": updated["id"], "suspect_score": updated["suspect_score"]})
 
     if after_phase != before_phase:
-        socketio.emit("phase_change", {"phase_two": after_phase})
-
-    if action != "revive" and after_phase:
-        conn_alert = get_db()
-        conn_alert.execute("""
-            INSERT INTO messages (type, sender_id, recipient_id, body, is_anonymous, is_read, pinned)
-            VALUES ('public', NULL, NULL, ?, 0, 1, 1)
-        """, (f"{row['name']} has been murdered. Anyone could be a suspect now. Report suspicious behavior by accusing someone under 'Suspect' in your app.",))
-        conn_alert.commit()
-        murder_msg = conn_alert.execute("""
-            SELECT m.*, c.name AS sender_name, c.avatar_emoji
-            FROM messages m
-            LEFT JOIN characters c ON m.sender_id = c.id
-            WHERE m.id = (SELECT last_insert_rowid())
-        """).fetchone()
-        conn_alert.close()
-        if murder_msg:
-            socketio.emit("public_message", serialize_public_message(murder_msg))
-
-    trigger_thriller = action != "revive" and after_phase and not before_phase
+        broker.emit("phase_change", {"phase_two": after_phase})
+
+    if murder_msg:
+        broker.emit("public_message", murder_msg.payload)
+
     if trigger_thriller:
-        conn2 = get_db()
-        now_playing = force_play_thriller(conn2, requester_id=target_id)
-        queue_rows = get_up_next(conn2, limit=2)
-        conn2.close()
-        if now_playing:
-            socketio.emit("jukebox_now", serialize_now_playing(now_playing))
-        else:
-            socketio.emit("jukebox_stop")
-        socketio.emit("jukebox_queue", [serialize_queue_row(r) for r in queue_rows])
+        jukebox.play_thriller(requester_id=target_id)
+        publish_jukebox()
 
     return redirect(url_for("gm"))
 
 @app.route("/gm/seed", methods=["POST"])
 def gm_seed():
     reset_and_seed()
-    last_accuse_times.clear()
-    conn = get_db()
-    scores = conn.execute("SELECT id, suspect_score, is_alive FROM characters").fetchall()
-    conn.close()
-    for row in scores:
-        socketio.emit("suspect_update", {"character_id": row["id"], "suspect_score": row["suspect_score"]})
-        socketio.emit("character_status", {"character_id": row["id"], "is_alive": bool(row["is_alive"]), "suspect_score": row["suspect_score"]})
-    socketio.emit("phase_change", {"phase_two": False})
-    socketio.emit("public_cleared")
-    socketio.emit("photobooth_clear")
-    socketio.emit("announcement_clear")
-    socketio.emit("jukebox_stop")
-    socketio.emit("jukebox_queue", [])
+    broker.emit("leaderboard", {"changes": leaderboard.snapshot()})
+    for row in leaderboard.board_order():
+        broker.emit("suspect_update", {"character_id": row["id"], "suspect_score": row["suspect_score"]})
+        broker.emit("character_status", {"character_id": row["id"], "is_alive": bool(row["is_alive"]), "suspect_score": row["suspect_score"]})
+    broker.emit("phase_change", {"phase_two": False})
+    broker.emit("public_cleared", {"epoch": get_feed_epoch()})
+    broker.emit("photobooth_clear")
+    broker.emit("announcement_clear")
+    broker.emit("jukebox_stop")
+    broker.emit("jukebox_queue", [])
     return redirect(url_for("gm"))
 
 
@@ -1271,11 +3294,12 @@ def gm_seed_get():
 
 @app.route("/gm/clear_public")
 def gm_clear_public():
-    conn = get_db()
-    conn.execute("DELETE FROM messages WHERE type = 'public'")
-    conn.commit()
-    conn.close()
-    socketio.emit("public_cleared")
+    def clear_public(conn):
+        conn.execute("DELETE FROM messages WHERE type = 'public'")
+        bump_feed_epoch(conn)
+
+    db_write(clear_public)
+    broker.emit("public_cleared", {"epoch": get_feed_epoch()})
     return redirect(url_for("gm"))
 
 @app.route("/gm/announce", methods=["POST"])
@@ -1285,60 +3309,70 @@ def gm_announce():
         return redirect(url_for("gm"))
     if len(text) > 280:
         text = text[:280]
-    socketio.emit("announcement", {"body": text})
+    broker.emit("announcement", {"body": text})
     return redirect(url_for("gm"))
 
 # ---------- Socket.IO ----------
 @socketio.on("join")
 def socket_join(data):
-    char_id = data.get("character_id")
-    if not char_id:
+    char_id = data.get("character_id") if data else None
+    identity = current_identity()
+    # Only the logged-in player may join their own room; the TV and GM pages
+    # only need broadcasts.
+    if not char_id or identity is None or identity["id"] != char_id:
         return
-    room = f"char-{char_id}"
-    join_room(room)
+    join_room(f"char-{char_id}")
+    emit("unread_counts", unread_counters.get(char_id))
+    wallet_since = data.get("wallet_since")
+    if isinstance(wallet_since, int):
+        # Replay whatever this client missed while it was disconnected.
+        rows = get_db().execute(WALLET_EVENTS_SINCE_SQL, (char_id, wallet_since, WALLET_CATCHUP_LIMIT)).fetchall()
+        for row in rows:
+            emit("wallet_event", serialize_wallet_event(row))
 
 @socketio.on("jukebox_finished")
 def jukebox_finished(data):
     queue_id = data.get("queue_id") if data else None
     if not queue_id:
         return
-    conn = get_db()
-    conn.execute("""
-        UPDATE jukebox_queue
-        SET status = 'played', ended_at = CURRENT_TIMESTAMP
-        WHERE id = ? AND status = 'playing'
-    """, (queue_id,))
-    conn.commit()
-    next_row = ensure_now_playing(conn)
-    queue_rows = get_up_next(conn, limit=2)
-    conn.close()
-    if next_row:
-        socketio.emit("jukebox_now", serialize_now_playing(next_row))
-    else:
-        socketio.emit("jukebox_stop")
-    socketio.emit("jukebox_queue", [serialize_queue_row(r) for r in queue_rows])
+    if jukebox.finish(queue_id, "played"):
+        publish_jukebox()
+
+@socketio.on("jukebox_duration")
+def jukebox_duration(data):
+    queue_id = data.get("queue_id") if data else None
+    duration = data.get("duration") if data else None
+    if not session.get("tv"):
+        return
+    if not queue_id or not isinstance(duration, (int, float)) or not 0 < duration < 24 * 3600:
+        return
+    jukebox.report_duration(queue_id, duration)
 
 @socketio.on("jukebox_skip")
 def jukebox_skip(data):
     queue_id = data.get("queue_id") if data else None
     if not queue_id:
         return
-    conn = get_db()
-    conn.execute("""
-        UPDATE jukebox_queue
-        SET status = 'skipped', ended_at = CURRENT_TIMESTAMP
-        WHERE id = ? AND status = 'playing'
-    """, (queue_id,))
-    conn.commit()
-    next_row = ensure_now_playing(conn)
-    queue_rows = get_up_next(conn, limit=2)
-    conn.close()
-    if next_row:
-        socketio.emit("jukebox_now", serialize_now_playing(next_row))
-    else:
-        socketio.emit("jukebox_stop")
-    socketio.emit("jukebox_queue", [serialize_queue_row(r) for r in queue_rows])
+    if jukebox.finish(queue_id, "skipped"):
+        publish_jukebox()
+
+# Bring the schema up to date before the server accepts any traffic.
+migrate_db()
+schedule_settlement()
 
 if __name__ == "__main__":
-    init_db()
+    if sys.argv[1:] == ["check-plans"]:
+        plan_problems = check_query_plans(get_db())
+        for problem in plan_problems:
+            print(problem)
+        print(f"{len(HOT_QUERIES)} hot queries checked, {len(plan_problems)} regressions.")
+        sys.exit(1 if plan_problems else 0)
+    if sys.argv[1:2] == ["verify-ledger"]:
+        repair = "--repair" in sys.argv[2:]
+        mismatches = verify_ledger(get_db(), repair=repair)
+        for row in mismatches:
+            print(f"{row['name']} (#{row['id']}): stored {row['balance']}, ledger {row['ledger_balance']}")
+        verb = "repaired" if repair else "found"
+        print(f"{len(mismatches)} balance mismatches {verb}.")
+        sys.exit(1 if mismatches and not repair else 0)
     socketio.run(app, host="0.0.0.0", port=5001, debug=True, allow_unsafe_werkzeug=True)
@@ -0,0 +1,29 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# Importing app migrates the database it points at, so aim it at a scratch
+# file before any test module imports it.
+os.environ["MYSTERY_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="mystery-tests-"), "mystery.db")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture
+def game(tmp_path, monkeypatch):
+    """A freshly seeded game; reseeding empties the photobooth, so point it at a scratch dir."""
+    import app
+    monkeypatch.setattr(app, "PHOTOBOOTH_DIR", tmp_path / "photobooth")
+    app.reset_and_seed()
+    return app
+
+
+@pytest.fixture
+def login(game):
+    def login(code):
+        client = game.app.test_client()
+        client.post("/app/login", data={"code": code})
+        return client
+    return login
@@ -0,0 +1,103 @@
+import os
+import shutil
+
+import pytest
+
+
+@pytest.fixture
+def songs(game, tmp_path, monkeypatch):
+    directory = tmp_path / "jukebox"
+    directory.mkdir()
+    for name in ("A-ha - Take On Me.mp3", "Toto - Africa.mp3"):
+        shutil.copy(game.JUKEBOX_DIR / "Devo - Whip It.mp3", directory / name)
+    catalog = game.SongCatalog(directory, tmp_path / "catalog.json")
+    monkeypatch.setattr(game, "song_catalog", catalog)
+    monkeypatch.setattr(game, "JUKEBOX_DIR", directory)
+    monkeypatch.setattr(game, "JUKEBOX_LOW_DIR", directory / "low")
+    catalog.get("A-ha - Take On Me.mp3")
+    return catalog
+
+
+def play(game, login, songs, duration_source):
+    song = songs.get("A-ha - Take On Me.mp3")
+    song["duration_source"] = duration_source
+    if duration_source is None:
+        song["duration"] = None
+    client = login("MOUSE")
+    for name in ("A-ha - Take On Me.mp3", "Toto - Africa.mp3"):
+        client.post("/app/jukebox/queue", data={"song_filename": name})
+    return client, game.jukebox.now()
+
+
+def tv_socket(game):
+    tv = game.app.test_client()
+    tv.get("/tv")
+    return game.socketio.test_client(game.app, flask_test_client=tv)
+
+
+def test_phone_cannot_report_a_duration(game, login, songs):
+    client, playing = play(game, login, songs, None)
+    phone = game.socketio.test_client(game.app, flask_test_client=client)
+    phone.emit("jukebox_duration", {"queue_id": playing["queue_id"], "duration": 200.5})
+    assert game.jukebox.now()["duration"] is None
+
+
+def test_tv_duration_for_an_unread_file_is_exact(game, login, songs):
+    _, playing = play(game, login, songs, None)
+    tv_socket(game).emit("jukebox_duration", {"queue_id": playing["queue_id"], "duration": 200.5})
+    assert game.jukebox.now()["duration"] == 200.5
+    _, advanced = game.jukebox.tick(playing["started_at"] + 200.5 + game.jukebox.late_grace_seconds + 0.5)
+    assert advanced
+
+
+def test_tv_duration_never_makes_a_bitrate_guess_exact(game, login, songs):
+    _, playing = play(game, login, songs, "bitrate")
+    tv_socket(game).emit("jukebox_duration", {"queue_id": playing["queue_id"], "duration": 200.5})
+    assert game.jukebox.now()["duration"] == 200.5
+    _, advanced = game.jukebox.tick(playing["started_at"] + 200.5 + 60)
+    assert not advanced
+    assert game.jukebox.now()["queue_id"] == playing["queue_id"]
+
+
+def test_duration_that_already_ran_out_is_ignored(game, login, songs):
+    _, playing = play(game, login, songs, None)
+    tv_socket(game).emit("jukebox_duration", {"queue_id": playing["queue_id"], "duration": 0.001})
+    assert game.jukebox.now()["duration"] is None
+
+
+def test_versioned_audio_is_cached_for_good(game, songs):
+    url = game.jukebox_audio_url("Toto - Africa.mp3")
+    response = game.app.test_client().get(url, headers={"Range": "bytes=0-9"})
+    assert response.status_code == 206
+    assert response.cache_control.immutable
+    assert response.cache_control.max_age == game.JUKEBOX_AUDIO_MAX_AGE
+
+
+@pytest.mark.parametrize("query", ["", "?v=1"])
+def test_unversioned_audio_is_revalidated(game, songs, query):
+    response = game.app.test_client().get(f"/jukebox/audio/Toto%20-%20Africa.mp3{query}")
+    assert response.cache_control.no_cache
+    assert not response.cache_control.immutable
+    assert response.headers["ETag"]
+    assert response.headers["Accept-Ranges"] == "bytes"
+
+
+def test_low_bitrate_url_follows_the_low_file(game, songs, monkeypatch):
+    monkeypatch.setattr(game, "JUKEBOX_PREFER_LOW_BITRATE", True)
+    low = game.JUKEBOX_LOW_DIR
+    low.mkdir()
+    (low / "Toto - Africa.mp3").write_bytes(b"x" * 10)
+    url = game.jukebox_audio_url("Toto - Africa.mp3")
+    assert url.endswith("&variant=low")
+    response = game.app.test_client().get(url)
+    assert response.data == b"x" * 10 and response.cache_control.immutable
+    (low / "Toto - Africa.mp3").write_bytes(b"y" * 10)
+    os.utime(low / "Toto - Africa.mp3", ns=(0, 0))
+    assert game.jukebox_audio_url("Toto - Africa.mp3") != url
+
+
+def test_missing_file_gets_a_plain_url_and_a_404(game, songs):
+    (game.JUKEBOX_DIR / "Toto - Africa.mp3").unlink()
+    url = game.jukebox_audio_url("Toto - Africa.mp3")
+    assert "?" not in url
+    assert game.app.test_client().get(url).status_code == 404
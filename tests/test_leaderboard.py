@@ -0,0 +1,15 @@
+def test_cold_start_counts_an_accusation_once(game, login):
+    client = login("MOUSE")
+    game.app.test_client().post("/gm/kill", data={"character_id": 3})
+    # A restart leaves the board unloaded until the first accusation lands.
+    game.leaderboard.clear()
+    client.post("/app/accuse", data={"accused_id": 4})
+    assert game.leaderboard.heat_for_window(game.SUSPECT_HEAT_WINDOW_SECONDS)[4] == 1
+
+
+def test_warm_board_adds_heat(game, login):
+    client = login("MOUSE")
+    game.app.test_client().post("/gm/kill", data={"character_id": 3})
+    game.leaderboard.snapshot()
+    client.post("/app/accuse", data={"accused_id": 4})
+    assert game.leaderboard.heat_for_window(game.SUSPECT_HEAT_WINDOW_SECONDS)[4] == 1
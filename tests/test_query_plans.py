@@ -0,0 +1,30 @@
+import pytest
+
+import app
+
+
+@pytest.fixture(scope="module")
+def conn():
+    app.migrate_db()
+    conn = app.open_db()
+    yield conn
+    conn.close()
+
+
+def test_uses_scratch_database():
+    assert app.DB_PATH != app.APP_DIR / "mystery.db"
+
+
+@pytest.mark.parametrize("query", app.HOT_QUERIES, ids=[query[0] for query in app.HOT_QUERIES])
+def test_hot_query_uses_its_index(conn, query):
+    assert app.query_plan_problems(conn, *query) == []
+
+
+def test_full_scan_is_reported(conn):
+    problems = app.query_plan_problems(conn, "unindexed", "SELECT * FROM messages WHERE body = ?", ("x",), "idx_messages_public_feed")
+    assert any("full table scan" in problem for problem in problems)
+
+
+def test_unused_jukebox_indexes_are_dropped(conn):
+    names = {row["name"] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert not names & {"idx_jukebox_queue_status", "idx_jukebox_queue_song"}
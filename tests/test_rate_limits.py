@@ -0,0 +1,63 @@
+import sqlite3
+
+import pytest
+
+JSON = {"Accept": "application/json"}
+
+
+@pytest.fixture
+def limited_posts(game, monkeypatch):
+    monkeypatch.setitem(game.rate_limiter.limits, "post", {"capacity": 2, "refill_seconds": 60})
+
+
+def post(client, content="a clue"):
+    return client.post("/app/post", data={"content": content}, headers=JSON)
+
+
+def test_bucket_allows_capacity_then_blocks(game, login, limited_posts):
+    client = login("MOUSE")
+    assert post(client).get_json()["ok"]
+    assert post(client).get_json()["ok"]
+    response = post(client, "one too many")
+    assert response.status_code == 400
+    assert response.get_json()["error"].startswith("Slow down! Try again in ")
+    assert 0 < game.rate_limiter.remaining(1, "post") <= 60
+    # The blocked post rolled back with its job.
+    assert not any(entry["body"] == "one too many" for entry in game.fetch_public_messages())
+
+
+def test_bucket_refills(game, login, limited_posts):
+    client = login("MOUSE")
+    post(client)
+    post(client)
+    assert post(client).status_code == 400
+    game.db_write(lambda conn: conn.execute("UPDATE rate_limits SET updated_at = updated_at - 60"))
+    assert game.rate_limiter.remaining(1, "post") == 0
+    assert post(client).get_json()["ok"]
+
+
+def test_remaining_sees_a_spend_from_another_process(game, login, limited_posts):
+    assert game.rate_limiter.remaining(1, "post") == 0
+    conn = sqlite3.connect(game.DB_PATH)
+    with conn:
+        conn.execute("INSERT INTO rate_limits (character_id, action, tokens, updated_at) VALUES (1, 'post', 0, strftime('%s', 'now'))")
+    conn.close()
+    assert game.rate_limiter.remaining(1, "post") > 0
+
+
+def test_unlimited_action_never_blocks(game, login):
+    client = login("MOUSE")
+    for _ in range(5):
+        assert client.post("/app/dm", data={"recipient_id": 2, "body": "psst"}, headers=JSON).get_json()["ok"]
+
+
+def test_config_limits_are_merged_and_normalised(game):
+    limits = game.load_rate_limits({"post": {"capacity": "5", "refill_seconds": 12}})
+    assert limits["post"] == {"capacity": 5, "refill_seconds": 12.0}
+    assert limits["accuse"]["refill_seconds"] == game.ACCUSE_COOLDOWN_SECONDS
+
+
+@pytest.mark.parametrize("limit", [{"capacity": 5}, {"refill_seconds": 12}, {"capacity": 0, "refill_seconds": 12}, {"capacity": "lots", "refill_seconds": 12}])
+def test_bad_config_limit_fails_at_load(game, limit):
+    with pytest.raises(ValueError):
+        game.load_rate_limits({"post": limit})
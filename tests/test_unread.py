@@ -0,0 +1,23 @@
+import threading
+
+
+def test_cold_load_during_commit_counts_once(game):
+    loaded = {}
+
+    def load():
+        loaded["counts"] = game.unread_counters.get(2)
+
+    def notify(conn):
+        conn.execute("INSERT INTO wallet_notifications (sender_id, recipient_id, amount, status) VALUES (1, 2, 10, 'unread')")
+        # A reader that asks while this batch's callbacks are still pending
+        # must wait for them rather than count the row and then the bump.
+        reader = threading.Thread(target=load)
+        game.on_commit(reader.start)
+        game.on_commit(lambda: reader.join(0.2))
+        game.bump_unread(2, "wallet", 1)
+        return reader
+
+    reader = game.db_write(notify)
+    reader.join(5)
+    assert loaded["counts"]["wallet"] == 1
+    assert game.unread_counters.get(2)["wallet"] == 1
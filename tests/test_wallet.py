@@ -0,0 +1,79 @@
+import pytest
+
+
+def query(game, sql, params=()):
+    return game.db_write(lambda conn: [tuple(row) for row in conn.execute(sql, params)])
+
+
+def queue_send(game, requester_id, target_id, amount):
+    def job(conn):
+        return conn.execute(
+            "INSERT INTO wallet_requests (requester_id, target_id, amount, request_type) VALUES (?, ?, ?, 'send')",
+            (requester_id, target_id, amount),
+        ).lastrowid
+    return game.db_write(job)
+
+
+def test_pending_send_settles_exactly_once(game):
+    covered = queue_send(game, 1, 2, 50)
+    too_big = queue_send(game, 1, 2, 10_000)
+    game.schedule_settlement()
+    game.db_write(game.settle_pending_sends)
+    game.schedule_settlement()
+
+    assert query(game, "SELECT id, status FROM wallet_requests ORDER BY id") == [(covered, "accepted"), (too_big, "declined")]
+    assert query(game, "SELECT from_id, to_id, amount FROM wallet_ledger WHERE kind = 'send'") == [(1, 2, 50)]
+    assert query(game, "SELECT id, balance FROM characters WHERE id IN (1, 2) ORDER BY id") == [
+        (1, game.STARTING_BALANCE - 50),
+        (2, game.STARTING_BALANCE + 50),
+    ]
+    assert game.roster.get(1)["balance"] == game.STARTING_BALANCE - 50
+    assert game.roster.get(2)["balance"] == game.STARTING_BALANCE + 50
+    assert query(game, "SELECT COUNT(*) FROM wallet_events WHERE request_id IN (?, ?)", (covered, too_big)) == [(3,)]
+
+
+def balances(game):
+    return dict(query(game, "SELECT id, balance FROM characters WHERE id IN (1, 2)"))
+
+
+def test_transfer_moves_money_and_records_it(game, login):
+    response = login("MOUSE").post("/app/wallet/send", data={"target_id": 2, "amount": 40}, headers={"Accept": "application/json"})
+    assert response.get_json()["balance"] == game.STARTING_BALANCE - 40
+    assert balances(game) == {1: game.STARTING_BALANCE - 40, 2: game.STARTING_BALANCE + 40}
+    assert game.roster.get(2)["balance"] == game.STARTING_BALANCE + 40
+    assert query(game, "SELECT from_id, to_id, amount, kind FROM wallet_ledger WHERE from_id IS NOT NULL") == [(1, 2, 40, "send")]
+    assert query(game, "SELECT character_id, kind, other_id, amount FROM wallet_events ORDER BY id") == [
+        (1, "sent", 2, 40),
+        (2, "received", 1, 40),
+    ]
+
+
+def test_overdraft_is_rejected(game, login):
+    response = login("MOUSE").post("/app/wallet/send", data={"target_id": 2, "amount": game.STARTING_BALANCE + 1}, headers={"Accept": "application/json"})
+    assert response.status_code == 400
+    assert game.db_write(lambda conn: game.ledger_transfer(conn, 1, 2, game.STARTING_BALANCE + 1, "send")) is False
+    assert balances(game) == {1: game.STARTING_BALANCE, 2: game.STARTING_BALANCE}
+    assert query(game, "SELECT COUNT(*) FROM wallet_ledger WHERE from_id IS NOT NULL") == [(0,)]
+
+
+def test_unknown_target_rolls_back_the_debit(game):
+    with pytest.raises(ValueError):
+        game.db_write(lambda conn: game.ledger_transfer(conn, 1, 999, 10, "send"))
+    assert balances(game)[1] == game.STARTING_BALANCE
+    assert game.roster.get(1)["balance"] == game.STARTING_BALANCE
+    assert query(game, "SELECT COUNT(*) FROM wallet_ledger WHERE from_id IS NOT NULL") == [(0,)]
+    assert query(game, "SELECT COUNT(*) FROM wallet_events") == [(0,)]
+
+
+def test_verify_ledger_is_clean_after_a_replay(game):
+    game.db_write(lambda conn: game.ledger_transfer(conn, 1, 2, 30, "send"))
+    game.db_write(lambda conn: game.ledger_transfer(conn, 2, 1, 5, "send"))
+    conn = game.open_db()
+    try:
+        assert game.verify_ledger(conn) == []
+        game.db_write(lambda wconn: wconn.execute("UPDATE characters SET balance = 0 WHERE id = 2"))
+        assert [row["id"] for row in game.verify_ledger(conn, repair=True)] == [2]
+        assert game.verify_ledger(conn) == []
+    finally:
+        conn.close()
+    assert balances(game) == {1: game.STARTING_BALANCE - 25, 2: game.STARTING_BALANCE + 25}